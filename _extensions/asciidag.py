@@ -41,14 +41,22 @@
 """
 
 import dagmatic
+import contextlib
 import tempfile
 import posixpath
 import shutil
+import struct
 import sphinx
+import json
 import os
+import re
+import sys
+import threading
+import time
 
 from subprocess import Popen, PIPE
 from docutils import nodes, utils, core
+from docutils.parsers.rst import directives
 from docutils.statemachine import ViewList
 from sphinx.util.compat import Directive
 
@@ -59,37 +67,124 @@ try:
 except ImportError:
     from sha import sha
 
+try:
+    from multiprocessing import cpu_count
+except ImportError:
+    def cpu_count():
+        return 1
+
 try:
     from sphinx.util.osutil import ensuredir, ENOENT
 except ImportError:
     from sphinx.util import ensuredir, ENOENT
+from errno import EEXIST, ESRCH
 
 class DagExtError(SphinxError):
     category = 'ASCII DAG extension error'
 
+class DagToolError(DagExtError):
+    '''a program needed for rendering is not installed'''
+
 class daginline(nodes.Inline, nodes.Element):
     pass
 
+def read_dag(text, window, reporter, lineno):
+    '''parse a dag while reading the document (cut down to window, if
+    given), so that mistakes are reported against the source line they are
+    on and the writers have nothing left to parse. Return (dag, messages);
+    dag is None if it could not be parsed.'''
+    try:
+        parsed = dagmatic.parse(text)
+    except dagmatic.DAGSyntaxError, exc:
+        msg = reporter.error('dag syntax error in column %d: %s'
+                             % (exc.col + 1, exc.msg), line=lineno + exc.row)
+        return None, [msg]
+    messages = []
+    if window:
+        try:
+            parsed = getattr(parsed, window[0])(*window[1:])
+        except KeyError, exc:
+            messages.append(reporter.warning('dag has no node %s, rendering '
+                                             'all of it' % exc, line=lineno))
+    return parsed, messages
+
 def dag_role(role, rawtext, text, lineno, inliner, option={}, content=[]):
     dag = utils.unescape(text, restore_backslashes=True)
-    return [daginline(dag=dag)], []
+    parsed, messages = read_dag(dag, None, inliner.reporter, lineno)
+    if parsed is None:
+        return [inliner.problematic(rawtext, rawtext, messages[0])], messages
+    node = daginline(dag=dag, parsed=parsed)
+    collect_dag(inliner.document.settings.env, node, parsed)
+    return [node], messages
 
 class dag(nodes.Part, nodes.Element):
     pass
 
+def rows_option(argument):
+    '''parse "first-last" (1-based, inclusive) into a (start, stop) slice of
+    the dag's lines'''
+    first, sep, last = argument.partition('-')
+    try:
+        first, last = int(first), int(last)
+    except ValueError:
+        raise ValueError('expected "first-last", e.g. "5-12"')
+    if first < 1 or last < first:
+        raise ValueError('invalid row range %r' % argument)
+    return (first - 1, last)
+
+def between_option(argument):
+    names = argument.split()
+    if len(names) != 2:
+        raise ValueError('expected two node names')
+    return tuple(names)
+
 class DagDirective(Directive):
     has_content = True
     required_arguments = 0
     optional_arguments = 1
     final_argument_whitespace = True
+    # only render part of a large dag
+    option_spec = {
+        'around': directives.unchanged_required,
+        'depth': directives.nonnegative_int,
+        'between': between_option,
+        'rows': rows_option,
+        'tiles': directives.nonnegative_int,
+    }
 
     def run(self):
         node = dag()
         node['dag'] = '\n'.join(self.content)
         node['caption'] = '\n'.join(self.arguments)
+        lineno = self.content_offset + 1
         if not self.content:
             node['caption'] = ''
             node['dag'] = '\n'.join(self.arguments)
+            lineno = self.lineno
+        windows = [o for o in ('around', 'between', 'rows')
+                   if o in self.options]
+        if len(windows) > 1:
+            raise self.error('the %s options of dag cannot be combined'
+                             % ' and '.join(':%s:' % o for o in windows))
+        if 'depth' in self.options and 'around' not in self.options:
+            raise self.error('the :depth: option of dag needs :around:')
+        window = None
+        if 'around' in self.options:
+            window = ('around', self.options['around'],
+                      self.options.get('depth', 1))
+        elif 'between' in self.options:
+            window = ('between',) + self.options['between']
+        elif 'rows' in self.options:
+            window = ('window',) + self.options['rows']
+        if 'tiles' in self.options:
+            node['tiles'] = self.options['tiles']
+
+        parsed, messages = read_dag(node['dag'], window,
+                                    self.state.document.reporter, lineno)
+        if parsed is None:
+            return messages
+        node['parsed'] = parsed
+        collect_dag(self.state.document.settings.env, node, parsed)
 
         node['bugfixed'] = False
         try:
@@ -110,12 +205,12 @@ class DagDirective(Directive):
             figure_node += caption_node
             node = figure_node
 
-        return [node]
+        return [node] + messages
 
 DOC_HEAD = r'''
 \documentclass[tikz]{standalone}
-\usetikzlibrary{%s}
 '''
+DOC_LIBS = r'\usetikzlibrary{%s}' + '\n'
 
 DEFAULT_TIKZ = r'''
 \tikzset{
@@ -180,6 +275,14 @@ DEFAULT_TIKZ = r'''
     dotted
   },
   markeredge/.default={black},
+%%
+  elidededge/.style={
+    draw=#1,
+    latex-,
+    thick,
+    dashed
+  },
+  elidededge/.default={gray},
 %%
   poof/.style={
     draw,
@@ -267,6 +370,12 @@ BITBUCKET_TIKZ = r'''
     dotted
   },
   markeredge/.default={gray!80},
+%%
+  elidededge/.style={
+    edge,
+    dashed
+  },
+  elidededge/.default={gray!40},
 %%
   poof/.style={
     draw=gray!80,
@@ -288,133 +397,1367 @@ DOC_BODY = r'''
 \end{document}
 '''
 
+# the same, with one page per picture (for dvisvgm)
+DOC_PAGES = r'''
+\begin{document}
+%s
+\end{document}
+'''
+DOC_PAGE = r'''\begin{tikzpicture}
+%s
+\end{tikzpicture}'''
+
+# make tikz talk to dvisvgm rather than dvips when latex writes a dvi
+DVISVGM_DRIVER = r'\def\pgfsysdriver{pgfsys-dvisvgm.def}' + '\n'
+
 DEFAULT_LIBS = ('arrows.meta, fadings, graphs, shapes, '
                 'decorations.markings, calc')
+# the libraries that the styles of the builtin preambles need
+STYLE_LIBS = {
+    'tmpchangeset': ['decorations.markings'],
+    'poof': ['shapes'],
+}
+
+_dag_lock = threading.Lock()
+_probe_lock = threading.Lock()
+
+def dag_tempdir(builder):
+    '''scratch directory for this build, removed by cleanup_tempdir'''
+    with _dag_lock:
+        if not hasattr(builder, '_dag_tempdir'):
+            builder._dag_tempdir = tempfile.mkdtemp()
+    return builder._dag_tempdir
+
+class RenderContext(object):
+    '''what the render functions use of a translator, for rendering when
+    there is none'''
+    def __init__(self, builder):
+        self.builder = builder
+
+def dag_pool(builder):
+    '''thread pool for running renders in parallel (the work happens in
+    subprocesses, so threads are all we need)'''
+    with _dag_lock:
+        if not hasattr(builder, '_dag_pool'):
+            from multiprocessing.pool import ThreadPool
+            jobs = builder.config.dag_render_jobs or cpu_count()
+            builder._dag_pool = ThreadPool(jobs)
+    return builder._dag_pool
+
+MANIFEST = 'asciidag-manifest.json'
+JOURNAL = 'asciidag-journal'
+FORMATS = 'asciidag-formats'
+
+# the command used to check that each program is installed (and which
+# version it is), and the programs each dag_proc_suite needs
+TOOLS = {
+    'pdflatex': ['pdflatex', '--version'],
+    'pdftoppm': ['pdftoppm', '-v'],
+    'pdf2svg': ['pdf2svg'],
+    'convert': ['convert', '-version'],
+    'pnmcrop': ['pnmcrop', '-version'],
+    'pnmtopng': ['pnmtopng', '-version'],
+    'latex': ['latex', '--version'],
+    'dvisvgm': ['dvisvgm', '--version'],
+}
+SUITE_TOOLS = {
+    'pdf': ['pdflatex'],
+    'ImageMagick': ['pdflatex', 'pdftoppm', 'convert'],
+    'pdf2svg': ['pdflatex', 'pdf2svg'],
+    'Netpbm': ['pdflatex', 'pdftoppm', 'pnmcrop', 'pnmtopng'],
+    'dvisvgm': ['latex', 'dvisvgm'],
+}
+# the suites to pick from when dag_proc_suite isn't set, best first: dvisvgm
+# is the quickest since it needs no pdf
+SUITES = ['dvisvgm', 'pdf2svg', 'Netpbm', 'ImageMagick']
+TMP_PREFIX = '.asciidag-tmp-'
+# seconds between looks at an image that another build is rendering
+CACHE_POLL = 0.2
+
+# the cost model used until the manifest has enough timings to fit one:
+# seconds to start latex, and per unit of dag_units; and the extra units of
+# a transition arrow and a tmp node
+COST_OVERHEAD = 1.0
+COST_RATE = 0.01
+COST_MIN_POINTS = 3
+COST_TRANSITION = 8
+COST_TMP = 3
+
+def dag_manifest(builder):
+    '''what we know about rendered images, kept next to the doctrees so that
+    it survives between builds (and is shared by builders, since image names
+    are content hashes)'''
+    with _dag_lock:
+        if not hasattr(builder, '_dag_manifest'):
+            manifest = {}
+            try:
+                f = open(os.path.join(builder.doctreedir, MANIFEST))
+                try:
+                    manifest = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                pass
+            manifest.setdefault('images', {})
+            builder._dag_manifest = manifest
+    return builder._dag_manifest
+
+def save_manifest(builder):
+    if not hasattr(builder, '_dag_manifest'):
+        return
+    ensuredir(builder.doctreedir)
+    f = open(os.path.join(builder.doctreedir, MANIFEST), 'w')
+    try:
+        json.dump(builder._dag_manifest, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+svg_length_re = re.compile(r'\s*([0-9.]+)\s*(px|pt)?\s*$')
+
+def image_size(filename):
+    '''intrinsic (width, height) in css pixels of a png or svg image, or None
+    if we can't tell'''
+    f = open(filename, 'rb')
+    try:
+        head = f.read(4096)
+    finally:
+        f.close()
+    if head.startswith('\x89PNG\r\n\x1a\n') and head[12:16] == 'IHDR':
+        return list(struct.unpack('>II', head[16:24]))
+    svg = re.search(r'<svg\b[^>]*>', head)
+    if svg is None:
+        return None
+    size = []
+    for attr in ('width', 'height'):
+        # dvisvgm quotes with ', others with "
+        value = re.search(r'\s%s=(["\'])(.*?)\1' % attr, svg.group(0))
+        length = value and svg_length_re.match(value.group(2))
+        if not length:
+            return None
+        value = float(length.group(1))
+        if length.group(2) == 'pt':
+            value = value * 4 / 3
+        size.append(int(round(value)))
+    return size
+
+def record_image(builder, outfn):
+    '''remember the size of a rendered image in the manifest'''
+    images = dag_manifest(builder)['images']
+    fname = os.path.basename(outfn)
+    if fname not in images and not outfn.endswith('.pdf'):
+        size = image_size(outfn)
+        if size:
+            with _dag_lock:
+                images[fname] = size
+
+# seconds of the current render (in this thread) that shouldn't count as
+# its own, see timed()
+_clock = threading.local()
+
+def timed(fn, *args):
+    '''call fn(*args); return the seconds it took, less any spent on making
+    latex formats, which only the first render with a preamble pays'''
+    _clock.excluded = 0.0
+    start = time.time()
+    fn(*args)
+    return time.time() - start - _clock.excluded
+
+def record_timing(builder, fname, units, seconds):
+    '''remember how long an image of so many dag_units took to render'''
+    manifest = dag_manifest(builder)
+    with _dag_lock:
+        manifest.setdefault('timings', {})[fname] = [units, round(seconds, 3)]
+
+def dag_units(dag):
+    '''how much work a parsed dag is for latex, in rough units: one per node
+    and edge, more for transition arrows and the decorated tmp nodes'''
+    units = 0
+    for node in dag.nodemap.values():
+        units += 1 + len(node.parents) + len(node.precursors)
+        if isinstance(node, dagmatic.nodes.TransitionText):
+            units += COST_TRANSITION
+        elif node.annotation == 'T':
+            units += COST_TMP
+    return units
+
+def cost_model(builder):
+    '''(overhead, rate): the seconds a render takes are about overhead +
+    rate * dag_units, fitted to the timings in the manifest'''
+    points = dag_manifest(builder).get('timings', {}).values()
+    if len(points) < COST_MIN_POINTS:
+        return COST_OVERHEAD, COST_RATE
+    n = float(len(points))
+    sx = sum(p[0] for p in points)
+    sy = sum(p[1] for p in points)
+    sxx = sum(p[0] * p[0] for p in points)
+    sxy = sum(p[0] * p[1] for p in points)
+    spread = n * sxx - sx * sx
+    if spread <= 0:
+        # all the same size, so there's no telling the rate
+        return sy / n, COST_RATE
+    rate = (n * sxy - sx * sy) / spread
+    if rate < 0:
+        return sy / n, 0.0
+    return max((sy - rate * sx) / n, 0.0), rate
+
+def predict_cost(builder, model, fname, units):
+    '''seconds that rendering fname will take: as long as it took last
+    time, if it was rendered before (into an output directory that has
+    since been cleaned, say), or else what the model says'''
+    timing = dag_manifest(builder).get('timings', {}).get(fname)
+    if timing is not None:
+        return timing[1]
+    return model[0] + model[1] * units
+
+def html_img(self, fname, alt, style=None):
+    size = dag_manifest(self.builder)['images'].get(posixpath.basename(fname))
+    attrs = ''
+    if size:
+        attrs = ' width="%d" height="%d"' % tuple(size)
+    if style:
+        attrs += ' style="%s"' % style
+    return ('<img src="%s" alt="%s"%s loading="lazy" decoding="async" />' %
+            (fname, alt, attrs))
+
+def probe_tool(tool):
+    '''return the first line of the tool's version output, or None if it
+    cannot be run'''
+    try:
+        proc = Popen(TOOLS[tool], stdout=PIPE, stderr=PIPE)
+    except OSError, e:
+        if e.errno != ENOENT:
+            raise
+        return None
+    stdout, stderr = proc.communicate()
+    lines = (stdout or stderr).strip().splitlines()
+    return lines[0].strip() if lines else tool
+
+def dag_tools(builder):
+    '''{tool: version} for every program in TOOLS (None if it can't be
+    run), probed all at once the first time a render needs to know'''
+    with _probe_lock:
+        if not hasattr(builder, '_dag_tools'):
+            from multiprocessing.pool import ThreadPool
+            tools = sorted(TOOLS)
+            pool = ThreadPool(len(tools))
+            try:
+                versions = pool.map(probe_tool, tools)
+            finally:
+                pool.close()
+            builder._dag_tools = dict(zip(tools, versions))
+    return builder._dag_tools
+
+def proc_suite(builder):
+    '''dag_proc_suite, or if it isn't set, the first of SUITES that is
+    installed'''
+    suite = builder.config.dag_proc_suite
+    if suite:
+        return suite
+    if not hasattr(builder, '_dag_suite'):
+        tools = dag_tools(builder)
+        for suite in SUITES:
+            if all(tools.get(t) for t in SUITE_TOOLS[suite]):
+                break
+        builder._dag_suite = suite
+    return builder._dag_suite
+
+def have_tools(builder, suite):
+    '''whether the dags of suite can be rendered: by the render service
+    (which we can't check from here), or with the tools on this host. The
+    first time a tool turns out to be missing, say so.'''
+    tools = dag_tools(builder)
+    missing = [t for t in SUITE_TOOLS[suite] if not tools.get(t)]
+    with _dag_lock:
+        if not hasattr(builder, '_dag_missing'):
+            builder._dag_missing = set()
+        warn = set(missing) - builder._dag_missing
+        builder._dag_missing.update(warn)
+    for tool in sorted(warn):
+        if builder.config.dag_render_socket:
+            builder.warn('%s command cannot be run, dags that need it will '
+                         'only be rendered by the render service' % tool)
+        else:
+            builder.warn('%s command cannot be run, dags that need it will '
+                         'not be rendered' % tool)
+    return bool(builder.config.dag_render_socket or not missing)
+
+def latex_error(output):
+    '''the useful part of a failed render's output: latex's "! ..." error
+    up to the input line it points at, or else the first few lines'''
+    lines = output.splitlines()
+    for (i, line) in enumerate(lines):
+        if line.startswith('!'):
+            error = [line]
+            for line in lines[i + 1:i + 10]:
+                if line.startswith('[tmpdir]'):
+                    break
+                error.append(line)
+                if line.startswith('l.'):
+                    break
+            return '\n'.join(error)
+    return '\n'.join(lines[:10])
+
+def latex_failed(output):
+    '''whether a failed render's output has a latex error in it, which
+    rendering it again won't fix (unlike, say, a killed latex or a full
+    disk)'''
+    return any(line.startswith('!') and
+               not line.startswith("! I can't write on file")
+               for line in output.splitlines())
 
 def dag_style(self):
-    if not self.builder.config.dag_latex_preamble:
-        self.builder.config.dag_latex_preamble = DEFAULT_TIKZ
-    elif self.builder.config.dag_latex_preamble == 'bitbucket':
-        self.builder.config.dag_latex_preamble = BITBUCKET_TIKZ
-    return self.builder.config.dag_latex_preamble
-
-def render_dag(self, dag, libs=''):
-    hashkey = dag.encode('utf-8')
-    fname = 'asciidag-%s.png' % (sha(hashkey).hexdigest())
+    '''the tikz styles of dag_latex_preamble, with the builtin ones looked
+    up. The config itself is left alone: it is pickled with the
+    environment, and a changed value would make sphinx read every
+    document again next time.'''
+    preamble = self.builder.config.dag_latex_preamble
+    if not preamble:
+        return DEFAULT_TIKZ
+    if preamble == 'bitbucket':
+        return BITBUCKET_TIKZ
+    return preamble
+
+def parse_dag(self, node):
+    '''the node's dag, as parsed by the directive or role'''
+    parsed = node.get('parsed')
+    if parsed is None:
+        # a node that somebody else made
+        parsed = dagmatic.parse(node.get('dag', ''))
+    return parsed
+
+def dag_libs(self, node, parsed):
+    '''the tikz libraries needed to render parsed, from node: only those
+    it uses, with the builtin preambles (loading them all takes latex
+    longer than drawing most dags), plus dag_tikzlibraries and the node's
+    own'''
+    config = self.builder.config
+    libs = ''
+    if dag_style(self) in (DEFAULT_TIKZ, BITBUCKET_TIKZ):
+        libs = ','.join(parsed.tikz_libraries(STYLE_LIBS))
+    elif not config.dag_tikzlibraries:
+        # we can't tell what a preamble of the user's needs
+        libs = DEFAULT_LIBS
+    libs += ',' + config.dag_tikzlibraries + ',' + node.get('libs', '')
+    libs = libs.replace(' ', '').replace('\t', '').split(',')
+    # sorted, so that dags that need the same share a preamble (and so a
+    # latex format and dvisvgm batches)
+    return ','.join(sorted(set(lib for lib in libs if lib)))
+
+def dag_head(self, libs, suite):
+    '''the latex preamble for rendering dags that need libs with suite'''
+    head = DOC_HEAD
+    if libs:
+        head += DOC_LIBS % libs
+    head += dag_style(self)
+    if suite == 'dvisvgm':
+        head = DVISVGM_DRIVER + head
+    return head
+
+def dag_fname(key, fmt):
+    fname = 'asciidag-%s.png' % key
+    if fmt != 'png':
+        fname = 'dag-%s.%s' % (key, fmt)
+    return fname
+
+def dag_outfn(builder, fname, fmt):
+    if fmt == 'pdf':
+        # the latex builder keeps its images next to the .tex file
+        return os.path.join(builder.outdir, fname)
+    return os.path.join(builder.outdir, '_images', fname)
+
+def dag_filenames(self, key, fmt):
+    '''(fname, relfn, outfn): the image's name, its uri in the output,
+    and the path it is written to'''
+    fname = dag_fname(key, fmt)
+    outfn = dag_outfn(self.builder, fname, fmt)
+    if fmt == 'pdf':
+        return fname, fname, outfn
+    return fname, posixpath.join(self.builder.imgpath, fname), outfn
+
+def image_format(builder):
+    '''the format of dag images in html output'''
     # if we're converting to svg, then we use a different extension
-    if 'svg' in self.builder.config.dag_proc_suite:
-        fname = 'dag-%s.svg' % (sha(hashkey).hexdigest())
-    relfn = posixpath.join(self.builder.imgpath, fname)
-    outfn = os.path.join(self.builder.outdir, '_images', fname)
+    if 'svg' in proc_suite(builder):
+        return 'svg'
+    return 'png'
 
-    if os.path.isfile(outfn):
-        return relfn
+def dag_key(self, fingerprint, libs, fmt):
+    '''cache key for a dag rendered to fmt: its structural fingerprint plus
+    all the settings that affect the rendered image (including the versions
+    of the programs that render it), so that every figure in the project
+    with the same shape shares one image'''
+    builder = self.builder
+    suite = proc_suite(builder)
+    tools = dag_tools(builder)
+    versions = [tools.get(t) or '' for t in
+                SUITE_TOOLS.get('pdf' if fmt == 'pdf' else suite, [])]
+    key = '\n'.join([fingerprint, libs, dag_style(self), suite,
+                     str(builder.config.dag_transparent)] + versions)
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return sha(key).hexdigest()
+
+def render_dag(self, dag, libs='', fmt=None, key=None, units=None):
+    if key is None:
+        key = sha(dag.encode('utf-8')).hexdigest()
+    if fmt is None:
+        fmt = image_format(self.builder)
+    fname, relfn, outfn = dag_filenames(self, key, fmt)
+
+    # figures already rendered (or found on disk) during this build
+    if not hasattr(self.builder, '_dag_images'):
+        self.builder._dag_images = {}
+    if outfn in self.builder._dag_images:
+        return self.builder._dag_images[outfn]
 
-    if hasattr(self.builder, '_dag_warned'):
+    if os.path.isfile(outfn):
+        record_image(self.builder, outfn)
+    elif not render_file(self.builder, dag, libs, fmt, fname, outfn, units):
         return None
+    self.builder._dag_images[outfn] = relfn
+    return relfn
 
-    ensuredir(os.path.dirname(outfn))
-    curdir = os.getcwd()
+def render_file(builder, dag, libs, fmt, fname, outfn, units=None):
+    '''render dag to outfn; return False if it can't be rendered here. If
+    the dag's cost in dag_units is given, the time it took is recorded to
+    learn from.'''
+    if hasattr(builder, '_dag_warned'):
+        return False
 
-    if not libs:
-        libs = DEFAULT_LIBS
-    latex = DOC_HEAD % libs
-    latex += dag_style(self)
-    latex += DOC_BODY % dag
-    if isinstance(latex, unicode):
-        latex = latex.encode('utf-8')
+    suite = 'pdf' if fmt == 'pdf' else proc_suite(builder)
+    if suite not in SUITE_TOOLS:
+        builder._dag_warned = True
+        raise DagExtError('Error (asciidag extension): Invalid configuration '
+                          'value for dag_proc_suite')
+    if not have_tools(builder, suite):
+        return False
 
-    if not hasattr(self.builder, '_dag_tempdir'):
-        tempdir = self.builder._dag_tempdir = tempfile.mkdtemp()
-    else:
-        tempdir = self.builder._dag_tempdir
+    # don't bother running latex again on a dag that failed last time
+    failures = dag_manifest(builder).setdefault('failures', {})
+    if fname in failures:
+        raise DagExtError('Error (asciidag extension): %s failed in an '
+                          'earlier build, change the dag or the settings '
+                          'to retry:\n%s' % (fname, failures[fname]))
+
+    job = {
+        'head': dag_head(RenderContext(builder), libs, suite),
+        'body': DOC_BODY % dag,
+        'fmt': fmt,
+        'outfn': outfn,
+        'suite': proc_suite(builder),
+        'transparent': builder.config.dag_transparent,
+    }
+    # journal the job so that an interrupted build can finish it next time
+    journal(builder, 'start', fname, job)
+    try:
+        seconds = cached_compile(builder, fname, job)
+    except DagToolError:
+        raise
+    except DagExtError, exc:
+        if latex_failed(str(exc)):
+            with _dag_lock:
+                failures[fname] = latex_error(str(exc))
+        journal(builder, 'failed', fname)
+        raise
+    journal(builder, 'done', fname)
 
-    os.chdir(tempdir)
+    if seconds is not None and units is not None:
+        record_timing(builder, fname, units, seconds)
+    record_image(builder, outfn)
+    return True
+
+def run_cmd(builder, tempdir, cmd, *args, **kwargs):
+    '''run cmd in tempdir, piping its output through any further commands
+    in args; return the output of the last one. env can be given as a
+    keyword argument.'''
+    env = kwargs.get('env')
+    cmds = [cmd] + list(args)
+    procs = []
+    prev = None
+    stdout = None
+
+    for cmd in cmds:
+        proc = start_cmd(builder, tempdir, cmd, stdin=prev, env=env)
+        prev = proc.stdout
+        procs += [proc]
+
+    for p, cmd in reversed(zip(procs, cmds)):
+        dummy, stderr = p.communicate()
+        if stdout is None:
+            stdout = dummy
+        check_cmd(p, cmd, stderr, stdout, tempdir)
+    return stdout
+
+def start_cmd(builder, tempdir, cmd, stdin=None, env=None):
+    '''start cmd in tempdir with its output piped back to us'''
+    try:
+        # renders start processes from several threads at once: without
+        # close_fds, one would hold on to the pipes of another (e.g. a
+        # standby latex, which never exits on its own) and keep it from
+        # seeing the end of its input or us the end of its output
+        return Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                     cwd=tempdir, env=env, close_fds=os.name != 'nt')
+    except OSError, e:
+        if e.errno != ENOENT:  # No such file or directory
+            raise
+        msg = '%s command cannot be run' % cmd[0]
+        builder.warn(msg)
+        dag_tools(builder)[cmd[0]] = None
+        raise DagToolError(msg)
+
+def check_cmd(proc, cmd, stderr, stdout, tempdir):
+    '''raise DagExtError with the output of cmd if it failed'''
+    if proc.returncode != 0:
+        msg = ('Error (asciidag extension): %s exited with\n'
+               '[stderr]\n%s\n'
+               '[stdout]\n%s\n'
+               '[tmpdir]\n%s')
+        raise DagExtError(msg % (cmd[0], stderr, stdout, tempdir))
+
+@contextlib.contextmanager
+def output_file(outfn):
+    '''yield a temporary filename next to outfn (keeping the extension,
+    which ImageMagick looks at) and rename it into place when the block is
+    done, so that an interrupted build never leaves a truncated image
+    behind'''
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(outfn),
+                                 prefix=TMP_PREFIX,
+                                 suffix='-' + os.path.basename(outfn))
+    os.close(fd)
+    try:
+        yield tmpfn
+        if os.name == 'nt' and os.path.exists(outfn):
+            # rename() won't replace files on windows
+            os.remove(outfn)
+        os.rename(tmpfn, outfn)
+    finally:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
 
-    tf = open('asciidag.tex', 'wb')
+def write_latex(builder, latex):
+    '''write latex to asciidag.tex in a new directory and return that
+    directory. Every render gets its own so that renders can run in
+    parallel (see render_dags).'''
+    if isinstance(latex, unicode):
+        latex = latex.encode('utf-8')
+    tempdir = tempfile.mkdtemp(dir=dag_tempdir(builder))
+    tf = open(os.path.join(tempdir, 'asciidag.tex'), 'wb')
     tf.write(latex)
     tf.close()
+    return tempdir
 
-    def run_cmd(cmd, *args):
-        cmds = [cmd] + list(args)
-        procs = []
-        prev = None
-        stdout = None
+_format_lock = threading.Lock()
 
-        for cmd in cmds:
-            try:
-                os.chdir(tempdir)
-                proc = Popen(cmd, stdin=prev, stdout=PIPE, stderr=PIPE)
-                prev = proc.stdout
-                procs += [proc]
-            except OSError, e:
-                if e.errno != ENOENT:  # No such file or directory
+def dag_format(builder, engine, head):
+    '''name of a format for engine with head (a dag preamble) already
+    loaded, so that latex starts warm instead of reading tikz and the
+    styles for every figure. Formats are built on first use and kept with
+    the doctrees; their names cover the engine version, so upgrading tex
+    makes new ones. Return None if formats are off or this one can't be
+    built.'''
+    if not builder.config.dag_latex_format:
+        return None
+    key = '\n'.join([engine, dag_tools(builder).get(engine) or '', head])
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    name = 'asciidag-%s' % sha(key).hexdigest()
+    fmtdir = os.path.join(builder.doctreedir, FORMATS)
+    fmtfn = os.path.join(fmtdir, name + '.fmt')
+
+    with _format_lock:
+        if not hasattr(builder, '_dag_formats'):
+            builder._dag_formats = {}
+        formats = builder._dag_formats
+        if name not in formats:
+            formats[name] = os.path.isfile(fmtfn)
+            if not formats[name]:
+                tempdir = write_latex(builder, head + '\\dump\n')
+                try:
+                    run_cmd(builder, tempdir,
+                            [engine, '-ini', '-jobname=' + name,
+                             '--interaction=nonstopmode', '&' + engine,
+                             'asciidag.tex'])
+                    ensuredir(fmtdir)
+                    with output_file(fmtfn) as tmpfn:
+                        shutil.copyfile(os.path.join(tempdir,
+                                                     name + '.fmt'), tmpfn)
+                    formats[name] = True
+                except DagToolError:
                     raise
-                msg = '%s command cannot be run' % cmd[0]
-                self.builder.warn(msg)
-                self.builder._dag_warned = True
-                raise DagExtError(msg)
+                except (DagExtError, IOError), exc:
+                    builder.warn('could not precompile the dag preamble, '
+                                 'rendering without it: %s'
+                                 % latex_error(str(exc)))
+    if not formats[name]:
+        return None
+    return name
+
+def format_env(builder):
+    '''the environment for latex to find the formats of dag_format in'''
+    env = dict(os.environ)
+    # a trailing separator keeps the default search path
+    env['TEXFORMATS'] = (os.path.join(builder.doctreedir, FORMATS) +
+                         os.pathsep)
+    return env
+
+def retire_format(builder, name):
+    '''stop using a format that broke (e.g. tex was upgraded under it); the
+    next build makes it again'''
+    with _format_lock:
+        builder._dag_formats[name] = False
+        workers = getattr(builder, '_dag_workers', {}).pop(name, None)
+        if workers is not None:
+            workers.close()
+        try:
+            os.remove(os.path.join(builder.doctreedir, FORMATS,
+                                   name + '.fmt'))
+        except OSError:
+            pass
+
+# what a standby latex (see LatexWorkers) runs once the format has loaded
+# the preamble: wait for the name of a file with the rest of the document
+# on stdin (which tex only reads in scroll mode), then run it
+WORKER_MAIN = r'''{\endlinechar=-1 \scrollmode \global\read-1 to\asciidagjob}
+\nonstopmode
+\input{\asciidagjob}
+'''
+
+class LatexWorkers(object):
+    '''latex processes started ahead of time with a precompiled format (see
+    dag_format), which have loaded the preamble by the time there is a
+    figure for them. Each waits in its own directory, runs one figure (its
+    output file is only complete once latex exits) and is replaced by a
+    new standby as soon as it is taken.'''
+    def __init__(self, builder, engine, name, size):
+        self.builder = builder
+        self.cmd = [engine, '-fmt=' + name, '--interaction=nonstopmode',
+                    'asciidag.tex']
+        self.size = size
+        self.lock = threading.Lock()
+        self.standby = []               # (process, directory)
+
+    def start(self):
+        tempdir = write_latex(self.builder, WORKER_MAIN)
+        return (start_cmd(self.builder, tempdir, self.cmd, stdin=PIPE,
+                          env=format_env(self.builder)), tempdir)
+
+    def run(self, body):
+        '''render body (the document after the preamble) and return the
+        directory the output is in'''
+        with self.lock:
+            if self.standby:
+                proc, tempdir = self.standby.pop(0)
+            else:
+                proc, tempdir = self.start()
+            while len(self.standby) < self.size:
+                self.standby.append(self.start())
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        f = open(os.path.join(tempdir, 'figure.tex'), 'wb')
+        f.write(body)
+        f.close()
+        stdout, stderr = proc.communicate('figure\n')
+        check_cmd(proc, self.cmd, stderr, stdout, tempdir)
+        return tempdir
+
+    def close(self):
+        '''stop the standby processes'''
+        with self.lock:
+            standby, self.standby = self.standby, []
+        for (proc, tempdir) in standby:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+            proc.communicate()
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+def latex_workers(builder, engine, name):
+    '''the LatexWorkers for a format, or None if dag_latex_workers is off'''
+    size = builder.config.dag_latex_workers
+    if not size:
+        return None
+    with _format_lock:
+        if not hasattr(builder, '_dag_workers'):
+            builder._dag_workers = {}
+        if name not in builder._dag_workers:
+            builder._dag_workers[name] = LatexWorkers(builder, engine, name,
+                                                      size)
+        return builder._dag_workers[name]
+
+def close_workers(builder):
+    '''stop the standby latex processes of all formats'''
+    with _format_lock:
+        workers = getattr(builder, '_dag_workers', {})
+        builder._dag_workers = {}
+    for w in workers.values():
+        w.close()
+
+def run_latex(builder, engine, head, body):
+    '''write a latex document (head is the preamble) to a new directory
+    and run engine on it there, preferably with the preamble precompiled
+    (see dag_format) and by a latex that is already running (see
+    LatexWorkers); return the directory'''
+    # making the format (or waiting for another thread to) is only paid
+    # once, so it isn't part of what the render costs
+    began = time.time()
+    name = dag_format(builder, engine, head)
+    _clock.excluded = (getattr(_clock, 'excluded', 0.0) +
+                       time.time() - began)
+    if name is not None:
+        try:
+            workers = latex_workers(builder, engine, name)
+            if workers is not None:
+                return workers.run(body)
+            tempdir = write_latex(builder, body)
+            run_cmd(builder, tempdir,
+                    [engine, '-fmt=' + name, '--interaction=nonstopmode',
+                     'asciidag.tex'], env=format_env(builder))
+            return tempdir
+        except DagToolError:
+            raise
+        except DagExtError, exc:
+            error = exc
+
+    tempdir = write_latex(builder, head + body)
+    run_cmd(builder, tempdir,
+            [engine, '--interaction=nonstopmode', 'asciidag.tex'])
+    if name is not None:
+        # it works without the format, so the format is what's broken
+        builder.warn('precompiled dag preamble failed, not using it: %s'
+                     % latex_error(str(error)))
+        retire_format(builder, name)
+    return tempdir
+
+def dvisvgm_cmd(builder, exact=True):
+    '''dvisvgm cropped to the exact bounding box of the picture (or, if not
+    exact, to the tikz bounding box that the dvisvgm driver reports), with
+    the text turned into paths (so the svg needs no fonts) and the glyph
+    cache kept between builds'''
+    cache = os.path.join(builder.doctreedir, 'asciidag-dvisvgm-cache')
+    ensuredir(cache)
+    # -e is --exact in dvisvgm 1.x and --exact-bbox in 2.x
+    bbox = ['-e'] if exact else []
+    return ['dvisvgm'] + bbox + ['--no-fonts', '--cache=' + cache]
+
+def cropped(body):
+    '''whether the picture of a dag may be trimmed to the ink on it: not
+    tiles, which are padded with invisible nodes to the height of their dag
+    (see DAG.tiles)'''
+    return dagmatic.EXTENT_SCOPE not in body
+
+def compile_dag(builder, job):
+    '''run latex and the converters for a job built by render_dag. The
+    output only appears at job['outfn'] once it is complete.'''
+    outfn = job['outfn']
+    ensuredir(os.path.dirname(outfn))
+
+    engine = 'pdflatex'
+    if job['fmt'] != 'pdf' and job['suite'] == 'dvisvgm':
+        engine = 'latex'
+    tempdir = run_latex(builder, engine, job['head'], job['body'])
+    crop = cropped(job['body'])
+
+    with output_file(outfn) as tmpfn:
+        if job['fmt'] == 'pdf':
+            # the standalone class has already cropped the picture for us
+            shutil.copyfile(os.path.join(tempdir, 'asciidag.pdf'), tmpfn)
+
+        elif job['suite'] == 'ImageMagick':
+            run_cmd(builder, tempdir,
+                    ['pdftoppm', '-r', '120', 'asciidag.pdf', 'asciidag'])
+            convert_args = []
+            if job['transparent']:
+                convert_args = ['-fuzz', '2%', '-transparent', 'white']
+
+            if crop:
+                convert_args.insert(0, '-trim')
+            run_cmd(builder, tempdir, ['convert'] + convert_args +
+                    ['asciidag-1.ppm', tmpfn])
+
+        elif job['suite'] == 'pdf2svg':
+            run_cmd(builder, tempdir, ['pdf2svg', 'asciidag.pdf', tmpfn])
+
+        elif job['suite'] == 'dvisvgm':
+            run_cmd(builder, tempdir, dvisvgm_cmd(builder, crop) +
+                    ['--page=1', '-o', tmpfn, 'asciidag.dvi'])
+
+        else:  # Netpbm
+            run_cmd(builder, tempdir,
+                    ['pdftoppm', '-r', '120', 'asciidag.pdf', 'asciidag'])
+            pnm_args = []
+            if job['transparent']:
+                pnm_args = ['-transparent', 'white']
+
+            if crop:
+                pngdata = run_cmd(builder, tempdir,
+                                  ['pnmcrop', 'asciidag-1.ppm'],
+                                  ['pnmtopng'] + pnm_args)
+            else:
+                pngdata = run_cmd(builder, tempdir,
+                                  ['pnmtopng'] + pnm_args + ['asciidag-1.ppm'])
+
+            f = open(tmpfn, 'wb')
+            f.write(pngdata)
+            f.close()
+
+    # (failed renders keep theirs, for the error message to point at)
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+def compile_pages(builder, head, figures):
+    '''render figures, a list of (dag, outfn), to svg with a single latex
+    and dvisvgm run: each dag goes on its own page of one dvi. The dags
+    should either all be cropped() or none of them.'''
+    tempdir = run_latex(builder, 'latex', head, DOC_PAGES % '\n'.join(
+        DOC_PAGE % dag for (dag, outfn) in figures))
+    crop = all(cropped(dag) for (dag, outfn) in figures)
+    run_cmd(builder, tempdir, dvisvgm_cmd(builder, crop) +
+            ['--page=1-', '-o', 'page-%p.svg', 'asciidag.dvi'])
+
+    # dvisvgm may pad the page numbers, so go by their value
+    pages = {}
+    for name in os.listdir(tempdir):
+        m = re.match(r'page-(\d+)\.svg$', name)
+        if m:
+            pages[int(m.group(1))] = os.path.join(tempdir, name)
+    if len(pages) != len(figures):
+        raise DagExtError('Error (asciidag extension): dvisvgm wrote %d '
+                          'pages for %d dags' % (len(pages), len(figures)))
+    for (i, (dag, outfn)) in enumerate(figures):
+        ensuredir(os.path.dirname(outfn))
+        with output_file(outfn) as tmpfn:
+            shutil.copyfile(pages[i + 1], tmpfn)
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+def compile_job(builder, job):
+    '''compile_dag(builder, job), on the render service if there is one'''
+    if not service_compile(builder, job):
+        compile_dag(builder, job)
+
+def service_compile(builder, job):
+    '''have the render service at dag_render_socket (see serve()) render
+    job; return False if there is no service to talk to (or it can't run
+    the tools), in which case the caller renders it'''
+    path = builder.config.dag_render_socket
+    if not path or getattr(builder, '_dag_service_down', False):
+        return False
+    import socket
+    request = json.dumps({'job': dict((k, v) for (k, v) in job.items()
+                                      if k != 'outfn')})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            sock.sendall(request + '\n')
+            f = sock.makefile('rb')
+            try:
+                reply = json.loads(f.readline())
             finally:
-                os.chdir(curdir)
-
-        for p, cmd in reversed(zip(procs, cmds)):
-            dummy, stderr = p.communicate()
-            if stdout is None:
-                stdout = dummy
-            if p.returncode != 0:
-                msg = ('Error (asciidag extension): %s exited with\n'
-                       '[stderr]\n%s\n'
-                       '[stdout]\n%s\n'
-                       '[tmpdir]\n%s')
-                raise DagExtError(msg % (cmd[0], stderr, stdout, tempdir))
-        return stdout
-
-    run_cmd(['pdflatex', '--interaction=nonstopmode', 'asciidag.tex'])
-    run_cmd(['pdftoppm', '-r', '120', 'asciidag.pdf', 'asciidag'])
-
-    os.chdir(tempdir)
-    if self.builder.config.dag_proc_suite == 'ImageMagick':
-        convert_args = []
-        if self.builder.config.dag_transparent:
-            convert_args = ['-fuzz', '2%', '-transparent', 'white']
-
-        run_cmd(['convert', '-trim'] + convert_args + ['asciidag-1.ppm', outfn])
-
-    elif self.builder.config.dag_proc_suite == 'pdf2svg':
-        run_cmd(['pdf2svg', 'asciidag.pdf', outfn])
-
-    elif self.builder.config.dag_proc_suite == 'Netpbm':
-        pnm_args = []
-        if self.builder.config.dag_transparent:
-            pnm_args = ['-transparent', 'white']
-
-        pngdata = run_cmd(['pnmcrop', 'dag-1.ppm'], ['pnmtopng'] + pnm_args)
-
-        f = open(outfn, 'wb')
-        f.write(pngdata)
+                f.close()
+        except (socket.error, ValueError), exc:
+            builder.warn('dag render service at %s is not available, '
+                         'rendering here instead: %s' % (path, exc))
+            builder._dag_service_down = True
+            return False
+    finally:
+        sock.close()
+
+    if 'error' in reply:
+        if reply.get('tool'):
+            return False
+        raise DagExtError(reply['error'])
+    ensuredir(os.path.dirname(job['outfn']))
+    with output_file(job['outfn']) as tmpfn:
+        shutil.copyfile(reply['path'], tmpfn)
+    return True
+
+def cache_dir(builder):
+    '''the dag_cache_dir shared with other builds, or None'''
+    if not builder.config.dag_cache_dir:
+        return None
+    # relative to conf.py, like other paths in the configuration
+    return os.path.join(builder.confdir, builder.config.dag_cache_dir)
+
+def cache_fetch(builder, fname, outfn):
+    '''copy fname from the shared cache to outfn if it is there; return
+    whether it was'''
+    cachefn = os.path.join(cache_dir(builder), fname)
+    if not os.path.isfile(cachefn):
+        return False
+    ensuredir(os.path.dirname(outfn))
+    try:
+        with output_file(outfn) as tmpfn:
+            shutil.copyfile(cachefn, tmpfn)
+    except (IOError, OSError):
+        # removed while we were copying
+        return False
+    return True
+
+def cache_lock(builder, fname):
+    '''try to take the lock on rendering fname into the shared cache; return
+    whether we got it. A lock whose owner died (on this host) or that
+    hasn't been touched (see cache_heartbeat) for dag_cache_lock_timeout
+    is broken.'''
+    import socket
+    lockfn = os.path.join(cache_dir(builder), fname + '.lock')
+    # the nonce tells our lock from one taken after ours was broken
+    owner = '%d %s %f %s\n' % (os.getpid(), socket.gethostname(),
+                               time.time(), os.urandom(8).encode('hex'))
+    try:
+        fd = os.open(lockfn, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0666)
+    except OSError, e:
+        if e.errno != EEXIST:
+            raise
+    else:
+        os.write(fd, owner)
+        os.close(fd)
+        with _dag_lock:
+            if getattr(builder, '_dag_locks', None) is None:
+                builder._dag_locks = {}
+                heartbeat = threading.Thread(target=cache_heartbeat,
+                                             args=(builder,))
+                heartbeat.daemon = True
+                heartbeat.start()
+            builder._dag_locks[lockfn] = owner
+        return True
+
+    try:
+        f = open(lockfn)
+        try:
+            held = f.read()
+        finally:
+            f.close()
+        age = time.time() - os.path.getmtime(lockfn)
+    except (IOError, OSError):
+        # just released
+        return False
+    stale = age > builder.config.dag_cache_lock_timeout
+    fields = held.split()
+    if not stale and len(fields) >= 3 and fields[1] == owner.split()[1]:
+        try:
+            os.kill(int(fields[0]), 0)
+        except OSError, e:
+            stale = e.errno == ESRCH
+        except ValueError:
+            pass
+    if stale:
+        builder.warn('breaking stale dag render lock %s (held by %s)'
+                     % (lockfn, ' '.join(fields[:2])))
+        try:
+            os.remove(lockfn)
+        except OSError:
+            pass
+    return False
+
+def lock_owner(lockfn):
+    '''what is in a lock file, or None if there is none'''
+    try:
+        f = open(lockfn)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def cache_unlock(builder, fname):
+    '''release a lock taken by cache_lock, unless it was broken and someone
+    else has it now'''
+    lockfn = os.path.join(cache_dir(builder), fname + '.lock')
+    with _dag_lock:
+        locks = getattr(builder, '_dag_locks', None) or {}
+        owner = locks.pop(lockfn, None)
+    if owner is not None and lock_owner(lockfn) == owner:
+        try:
+            os.remove(lockfn)
+        except OSError:
+            pass
+
+def cache_heartbeat(builder):
+    '''touch the locks we hold every so often, so that other builds can
+    tell a long render from a dead one; stop once we hold none (cache_lock
+    starts another)'''
+    while True:
+        time.sleep(builder.config.dag_cache_lock_timeout / 4.0)
+        with _dag_lock:
+            held = builder._dag_locks.items()
+            if not held:
+                builder._dag_locks = None
+                return
+        for (lockfn, owner) in held:
+            if lock_owner(lockfn) == owner:
+                try:
+                    os.utime(lockfn, None)
+                except OSError:
+                    pass
+
+def cache_publish(builder, fname, outfn):
+    '''copy a freshly rendered image into the shared cache'''
+    with output_file(os.path.join(cache_dir(builder), fname)) as tmpfn:
+        shutil.copyfile(outfn, tmpfn)
+
+def cache_failure(builder, failfn):
+    '''the {'error': message, 'tries': count} in a failure marker in the
+    shared cache, or None if there is none or it is older than
+    dag_cache_failure_ttl'''
+    try:
+        age = time.time() - os.path.getmtime(failfn)
+        f = open(failfn)
+        try:
+            failure = json.loads(f.read())
+        finally:
+            f.close()
+    except (OSError, IOError, ValueError):
+        return None
+    if age > builder.config.dag_cache_failure_ttl:
+        return None
+    return failure
+
+def cached_compile(builder, fname, job):
+    '''compile_dag(builder, job), sharing the result through dag_cache_dir
+    (if set) with other builds, on this host or others: whoever takes the
+    lock on an image renders it, the rest wait for it to appear. Return
+    the seconds it took to render here (see timed()), or None if it was
+    fetched.
+
+    A latex error leaves a failure marker for the others. The first one to
+    find it renders the dag once more; only once that fails as well do
+    the rest take the marker's word for it, until it expires.'''
+    cachedir = cache_dir(builder)
+    if cachedir is None:
+        return timed(compile_job, builder, job)
+    ensuredir(cachedir)
+    failfn = os.path.join(cachedir, fname + '.failed')
+
+    def check_failure():
+        failure = cache_failure(builder, failfn)
+        if failure is not None and failure['tries'] > 1:
+            raise DagExtError(failure['error'])
+        return failure
+
+    while True:
+        if cache_fetch(builder, fname, job['outfn']):
+            return None
+        check_failure()
+        if cache_lock(builder, fname):
+            break
+        time.sleep(CACHE_POLL)
+
+    try:
+        # it may have appeared between looking and locking
+        if cache_fetch(builder, fname, job['outfn']):
+            return None
+        failure = check_failure()
+        try:
+            seconds = timed(compile_job, builder, job)
+        except DagToolError:
+            # that's just us
+            raise
+        except DagExtError, exc:
+            if latex_failed(str(exc)):
+                tries = failure['tries'] + 1 if failure else 1
+                with output_file(failfn) as tmpfn:
+                    f = open(tmpfn, 'w')
+                    f.write(json.dumps({'error': str(exc), 'tries': tries}))
+                    f.close()
+            raise
+        cache_publish(builder, fname, job['outfn'])
+        if failure is not None:
+            try:
+                os.remove(failfn)
+            except OSError:
+                pass
+        return seconds
+    finally:
+        cache_unlock(builder, fname)
+
+def journal(builder, action, fname, job=None):
+    '''append to the render journal in the doctree directory: one json list
+    per line, either ["start", fname, job] or ["done", fname]'''
+    entry = [action, fname]
+    if job is not None:
+        entry.append(job)
+    line = json.dumps(entry) + '\n'
+    with _dag_lock:
+        ensuredir(builder.doctreedir)
+        f = open(os.path.join(builder.doctreedir, JOURNAL), 'a')
+        try:
+            f.write(line)
+        finally:
+            f.close()
+
+def resume_renders(app):
+    '''finish the renders that an interrupted build left unfinished'''
+    builder = app.builder
+    path = os.path.join(builder.doctreedir, JOURNAL)
+    pending = {}
+    try:
+        f = open(path)
+    except IOError:
+        return
+    try:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the line being written when we were killed
+                continue
+            if entry[0] == 'start':
+                pending[entry[1]] = entry[2]
+            else:  # done or failed
+                pending.pop(entry[1], None)
+    finally:
         f.close()
+    os.remove(path)
+
+    jobs = []
+    for (fname, job) in sorted(pending.items()):
+        outdir = os.path.dirname(job['outfn'])
+        # leftovers from renders that were killed before their rename
+        if os.path.isdir(outdir):
+            for leftover in os.listdir(outdir):
+                if leftover.startswith(TMP_PREFIX):
+                    os.remove(os.path.join(outdir, leftover))
+        if os.path.isfile(job['outfn']) or 'head' not in job:
+            # done, or journaled by an older version
+            continue
+        # settings changed since: the figure will get a new name anyway
+        if (job['suite'] != proc_suite(builder) or
+                job['transparent'] != builder.config.dag_transparent):
+            continue
+        suite = 'pdf' if job['fmt'] == 'pdf' else job['suite']
+        if not have_tools(builder, suite):
+            continue
+        jobs.append((fname, job))
+    if not jobs:
+        return
+
+    builder.info('resuming %d unfinished dag render(s)' % len(jobs))
+    failures = dag_manifest(builder).setdefault('failures', {})
+
+    def resume(item):
+        fname, job = item
+        journal(builder, 'start', fname, job)
+        try:
+            cached_compile(builder, fname, job)
+        except DagExtError, exc:
+            if latex_failed(str(exc)):
+                with _dag_lock:
+                    failures[fname] = latex_error(str(exc))
+            journal(builder, 'failed', fname)
+            builder.warn('could not resume render of %s: %s' % (fname, exc))
+            return
+        journal(builder, 'done', fname)
+        record_image(builder, job['outfn'])
+
+    dag_pool(builder).map(resume, jobs)
 
+def batch_dags(self, jobs):
+    '''with dvisvgm, render the missing svgs among several (dag, libs,
+    fmt, key, units) jobs a few dvi files at a time, so that latex and
+    dvisvgm start once per file instead of once per figure. This only fills
+    in the images: render_dag then finds them, and renders whatever failed
+    one at a time to pinpoint the error. Return the seconds of work it
+    took.'''
+    builder = self.builder
+    if not all(dag_tools(builder).get(t) for t in SUITE_TOOLS['dvisvgm']):
+        return 0.0
+    failures = dag_manifest(builder).get('failures', {})
+    cachedir = cache_dir(builder)
+    if cachedir is not None:
+        ensuredir(cachedir)
+    model = cost_model(builder)
+    groups = {}
+    for (dag, libs, fmt, key, units) in jobs:
+        if fmt not in (None, 'svg') or key is None:
+            continue
+        fname = dag_fname(key, 'svg')
+        outfn = dag_outfn(builder, fname, 'svg')
+        if os.path.isfile(outfn) or fname in failures:
+            continue
+        if cachedir is not None:
+            # only batch what nobody else is rendering; render_dag will
+            # wait for the rest
+            if (cache_fetch(builder, fname, outfn) or
+                    not cache_lock(builder, fname)):
+                continue
+        # tiles aren't cropped like the rest (see compile_pages), and a
+        # figure shouldn't come out differently for what it is batched with
+        group = (dag_head(self, libs, 'dvisvgm'), cropped(dag))
+        groups.setdefault(group, []).append(
+            (predict_cost(builder, model, fname, units), dag, outfn, fname,
+             units))
+
+    # still one batch per worker, to keep them all busy, and about as
+    # expensive as each other: the biggest figures go first, each into the
+    # cheapest batch so far
+    batches = []
+    workers = builder.config.dag_render_jobs or cpu_count()
+    for ((head, crop), figures) in sorted(groups.items()):
+        bins = [[0.0, head, []]
+                for i in xrange(min(workers, len(figures)))]
+        for figure in sorted(figures, key=lambda f: f[0], reverse=True):
+            cheapest = min(bins, key=lambda b: b[0])
+            cheapest[0] += figure[0]
+            cheapest[2].append(figure[1:])
+        batches.extend(bins)
+    batches.sort(key=lambda b: b[0], reverse=True)
+
+    def run(batch):
+        cost, head, figures = batch
+        start = time.time()
+        try:
+            seconds = timed(compile_pages, builder, head,
+                            [f[:2] for f in figures])
+            # render_dag won't render these again, so the timings for the
+            # cost model come from here: the batch's, shared out by size
+            total = float(sum(f[3] for f in figures)) or 1.0
+            for (dag, outfn, fname, units) in figures:
+                record_timing(builder, fname, units,
+                              seconds * units / total)
+                if cachedir is not None:
+                    cache_publish(builder, fname, outfn)
+        except DagExtError:
+            pass
+        finally:
+            if cachedir is not None:
+                for (dag, outfn, fname, units) in figures:
+                    cache_unlock(builder, fname)
+        return time.time() - start
+    return sum(dag_pool(builder).map(run, batches, 1))
+
+def render_dags(self, jobs):
+    '''render several (dag, libs, fmt, key, units) jobs in parallel, the
+    biggest first; return the list of filenames'''
+    if (len(jobs) > 1 and proc_suite(self.builder) == 'dvisvgm' and
+            not self.builder.config.dag_render_socket):
+        batch_dags(self, jobs)
+    if len(jobs) == 1:
+        return [render_dag(self, *jobs[0])]
+    order = sorted(xrange(len(jobs)), key=lambda i: jobs[i][4], reverse=True)
+    fnames = dag_pool(self.builder).map(lambda i: render_dag(self, *jobs[i]),
+                                        order, 1)
+    return [fname for (i, fname) in sorted(zip(order, fnames))]
+
+def collect_dag(env, node, parsed):
+    '''note the renders a figure will need, so that prerender_dags can
+    schedule all of them at once'''
+    ctx = RenderContext(env.app.builder)
+    jobs = []
+    for tile in dag_tiles(ctx, node, parsed) or [parsed]:
+        libs = dag_libs(ctx, node, tile)
+        jobs.append((tile.tikz_string(), libs, tile.fingerprint(),
+                     dag_units(tile)))
+    if not hasattr(env, 'dag_figures'):
+        env.dag_figures = {}
+    env.dag_figures.setdefault(env.docname, []).append(
+        (isinstance(node, daginline), jobs))
+
+def purge_dags(app, env, docname):
+    if hasattr(env, 'dag_figures'):
+        env.dag_figures.pop(docname, None)
+
+def merge_dags(app, env, docnames, other):
+    if not hasattr(env, 'dag_figures'):
+        env.dag_figures = {}
+    for docname in docnames:
+        if docname in getattr(other, 'dag_figures', {}):
+            env.dag_figures[docname] = other.dag_figures[docname]
+
+def prerender_dags(app, env):
+    '''render the figures of every document before writing starts, all
+    in one pool and the most expensive first (as predicted by cost_model),
+    so that the build isn't left waiting on a big figure that happened to
+    start last. Whatever fails is left for the writer to report.'''
+    builder = app.builder
+    if not any(getattr(env, 'dag_figures', {}).values()):
+        # no need to even look for the tools
+        return
+    if builder.format == 'html':
+        fmt = image_format(builder)
+        suite = proc_suite(builder)
+    elif builder.format == 'latex' and builder.config.dag_latex_external:
+        fmt = suite = 'pdf'
     else:
-        self.builder._dag_warned = True
-        os.chdir(curdir)
-        raise DagExtError('Error (asciidag extension): Invalid configuration '
-                          'value for dag_proc_suite')
+        return
+    if suite not in SUITE_TOOLS or not have_tools(builder, suite):
+        return
 
-    os.chdir(curdir)
-    return relfn
+    ctx = RenderContext(builder)
+    model = cost_model(builder)
+    failures = dag_manifest(builder).get('failures', {})
+    jobs = {}
+    for figures in getattr(env, 'dag_figures', {}).values():
+        for (inline, tiles) in figures:
+            if fmt == 'pdf' and inline and len(tiles) > 1:
+                # the latex writer doesn't tile inline dags
+                continue
+            for (dag, libs, fingerprint, units) in tiles:
+                key = dag_key(ctx, fingerprint, libs, fmt)
+                fname = dag_fname(key, fmt)
+                outfn = dag_outfn(builder, fname, fmt)
+                if (fname in jobs or fname in failures or
+                        os.path.isfile(outfn)):
+                    continue
+                jobs[fname] = (predict_cost(builder, model, fname, units),
+                               dag, libs, key, outfn, units)
+    if not jobs:
+        return
+    predicted = sum(job[0] for job in jobs.values())
+    builder.info('rendering %d dag(s), predicted to take %.1fs'
+                 % (len(jobs), predicted))
+
+    start = time.time()
+    work = 0.0
+    if (suite == 'dvisvgm' and len(jobs) > 1 and
+            not builder.config.dag_render_socket):
+        # (cost, dag, libs, key, outfn, units) -> (dag, libs, fmt, key,
+        # units)
+        work += batch_dags(ctx, [(job[1], job[2], fmt, job[3], job[5])
+                                 for job in jobs.values()])
+
+    def run(item):
+        fname, (cost, dag, libs, key, outfn, units) = item
+        began = time.time()
+        try:
+            if not os.path.isfile(outfn):
+                render_file(builder, dag, libs, fmt, fname, outfn, units)
+        except DagExtError:
+            pass
+        return time.time() - began
+    ordered = sorted(jobs.items(), key=lambda item: item[1][0], reverse=True)
+    work += sum(dag_pool(builder).map(run, ordered, 1))
+    builder.info('rendered %d dag(s) in %.1fs (%.1fs of work, predicted '
+                 '%.1fs)' % (len(jobs), time.time() - start, work, predicted))
+
+def dag_tiles(self, node, parsed):
+    '''split parsed into tiles if tiling is enabled and it is big enough to
+    need them; return None otherwise'''
+    width = node.get('tiles', self.builder.config.dag_tile_size)
+    if not width:
+        return None
+    tiles = parsed.tiles(width)
+    if len(tiles) < 2:
+        return None
+    return tiles
+
+def dag_job(self, node, tile, fmt):
+    '''the render_dags job for a tile of node's dag'''
+    libs = dag_libs(self, node, tile)
+    return (tile.tikz_string(), libs, fmt,
+            dag_key(self, tile.fingerprint(), libs, fmt), dag_units(tile))
 
 def html_visit_dag(self, node):
-    libs = self.builder.config.dag_tikzlibraries
-    if node.get('libs'):
-        libs += ',' + node.get('libs')
-    libs = libs.replace(' ', '').replace('\t', '').strip(', ')
-    fname = None
-    dag = dagmatic.parse(node.get('dag', '')).tikz_string()
+    fnames = None
+    parsed = parse_dag(self, node)
+    dag = parsed.tikz_string()
     caption = node.get('caption')
     bugfixed = node.get('bugfixed', False)
+    tiles = dag_tiles(self, node, parsed) or [parsed]
 
     try:
-        fname = render_dag(self, dag, libs)
+        fnames = render_dags(self, [dag_job(self, node, t, None)
+                                    for t in tiles])
     except DagExtError, exc:
         info = str(exc)[str(exc).find('!'):-1]
         sm = nodes.system_message(info, type='WARNING', level=2,
@@ -427,7 +1770,7 @@ def html_visit_dag(self, node):
                           'Error message: %s' % (dag, str(exc)))
         raise nodes.SkipNode
 
-    if fname is None:
+    if None in fnames:
         # something failed -- use text-only as a bad substitute
         self.body.append('<span class="math">%s</span>' %
                          self.encode(dag).strip())
@@ -435,44 +1778,142 @@ def html_visit_dag(self, node):
         if node.tagname == 'dag':
             self.body.append(self.starttag(node, 'div', CLASS='figure'))
             self.body.append('<p>')
-        self.body.append('<img src="%s" alt="%s" /></p>\n' %
-                         (fname, self.encode(node['dag']).strip()))
+        alt = self.encode(node['dag']).strip()
+        if len(fnames) == 1:
+            self.body.append(html_img(self, fnames[0], alt) + '</p>\n')
+        else:
+            # a strip of tiles; the browser only fetches the ones that
+            # are scrolled into view
+            self.body.append('<span class="dag-tiles" style="display: '
+                             'block; overflow-x: auto; white-space: nowrap">')
+            for fname in fnames:
+                # the tiles are all as tall as the dag (see DAG.tiles), so
+                # their rows line up as long as their tops do
+                self.body.append(html_img(self, fname, alt,
+                                          'vertical-align: top'))
+                alt = ''
+            self.body.append('</span></p>\n')
         if caption and not bugfixed:
             # convert the caption to html
-            caption = core.publish_parts(node['caption'],
-                                         writer_name='html')['body']
+            caption = caption_body(self.builder, node['caption'], 'html')
             self.body.append('<p class="caption">%s</p>' %
                              caption.strip())
         if node.tagname == 'dag':
             self.body.append('</div>')
     raise nodes.SkipNode
 
+def caption_body(builder, caption, writer):
+    '''caption converted by the docutils writer, once per build: each
+    publish_parts sets up a whole docutils publisher, which adds up'''
+    if not hasattr(builder, '_dag_captions'):
+        builder._dag_captions = {}
+        builder._dag_caption_time = 0.0
+    if (caption, writer) not in builder._dag_captions:
+        start = time.time()
+        body = core.publish_parts(caption, writer_name=writer)['body']
+        builder._dag_captions[(caption, writer)] = body
+        builder._dag_caption_time += time.time() - start
+    return builder._dag_captions[(caption, writer)]
+
+def latex_render_dags(self, node, tiles, dags):
+    '''render tiles to standalone pdfs (for dag_latex_external); return the
+    filenames or None if we should fall back to inlining the tikz code'''
+    if not self.builder.config.dag_latex_external:
+        return None
+    try:
+        fnames = render_dags(self, [dag_job(self, node, t, 'pdf')
+                                    for t in tiles])
+    except DagExtError, exc:
+        self.builder.warn('could not compile latex, inlining instead:\n'
+                          '-----\n'
+                          '%s\n'
+                          '-----\n'
+                          'Error message: %s' % ('\n'.join(dags), str(exc)))
+        return None
+    if None in fnames:
+        return None
+    return fnames
+
+def latex_pictures(self, node, tiles):
+    '''return a list of latex pictures, one per tile, and whether they
+    need the dag tikz styles'''
+    dags = [t.tikz_string() for t in tiles]
+    fnames = latex_render_dags(self, node, tiles, dags)
+    if fnames:
+        return [r'\includegraphics{%s}' % fname for fname in fnames], False
+    return ['\\begin{tikzpicture}' + dag + '\\end{tikzpicture}'
+            for dag in dags], True
+
 def latex_visit_daginline(self, node):
-    dag = dagmatic.parse(node.get('dag', '')).tikz_string()
-    self.body.append(dag_style(self))
-    self.body.append(r'\tikz{%s}' % dag)
+    parsed = parse_dag(self, node)
+    dag = parsed.tikz_string()
+    fnames = latex_render_dags(self, node, [parsed], [dag])
+    if fnames:
+        self.body.append(r'\includegraphics{%s}' % fnames[0])
+    else:
+        self.body.append(dag_style(self))
+        self.body.append(r'\tikz{%s}' % dag)
     raise nodes.SkipNode
 
 def latex_visit_dag(self, node):
-    latex = dag_style(self)
-    dag = dagmatic.parse(node.get('dag', '')).tikz_string()
-    if node['caption']:
-        caption = core.publish_parts(node['caption'],
-                                     writer_name='latex')['body']
-        latex += '\\begin{figure}[htp]\\centering\\begin{tikzpicture}' + \
-                 dag + '\\end{tikzpicture}' + '\\caption{' + \
-                 caption.strip() + '}\\end{figure}'
-    else:
-        latex += '\\begin{center}\\begin{tikzpicture}' + dag + \
-                 '\\end{tikzpicture}\\end{center}'
+    parsed = parse_dag(self, node)
+    pictures, inline = latex_pictures(self, node,
+                                      dag_tiles(self, node, parsed) or [parsed])
+    latex = ''
+    if inline:
+        latex = dag_style(self)
+    if isinstance(node.parent, nodes.figure):
+        # sphinx's figure is the float and has the caption
+        self.body.append(latex + '\\par\n'.join(pictures))
+        return
+    # tiles each get their own float (or paragraph) so that latex can
+    # spread them over several pages; the caption goes on the last one
+    for (i, picture) in enumerate(pictures):
+        if node['caption']:
+            latex += '\\begin{figure}[htp]\\centering' + picture
+            if i == len(pictures) - 1:
+                caption = caption_body(self.builder, node['caption'],
+                                       'latex')
+                latex += '\\caption{' + caption.strip() + '}'
+            latex += '\\end{figure}'
+        else:
+            latex += '\\begin{center}' + picture + '\\end{center}'
     self.body.append(latex)
 
+def text_visit_dag(self, node):
+    '''draw the dag with characters (see dagmatic.text) in a literal block,
+    for builders that can't show pictures; no latex needed'''
+    # box-drawing characters are too much for roff
+    ascii = self.builder.format == 'man'
+    drawing = dagmatic.text_string(parse_dag(self, node), ascii).rstrip()
+    nodes.literal_block(drawing, drawing).walkabout(self)
+    raise nodes.SkipNode
+
+def text_visit_daginline(self, node):
+    # no room for a drawing in a line of text
+    nodes.literal(node['dag'], node['dag']).walkabout(self)
+    raise nodes.SkipNode
+
 def depart_dag(self, node):
     pass
 
 def cleanup_tempdir(app, exc):
+    if hasattr(app.builder, '_dag_pool'):
+        app.builder._dag_pool.close()
+        app.builder._dag_pool.join()
+    close_workers(app.builder)
+    save_manifest(app.builder)
     if exc:
         return
+    if hasattr(app.builder, '_dag_captions'):
+        app.builder.info('converted %d dag caption(s) in %.2fs'
+                         % (len(app.builder._dag_captions),
+                            app.builder._dag_caption_time))
+    # every render finished, so the journal has nothing left to tell
+    try:
+        os.remove(os.path.join(app.builder.doctreedir, JOURNAL))
+    except OSError:
+        pass
     if not hasattr(app.builder, '_dag_tempdir'):
         return
     try:
@@ -480,25 +1921,49 @@ def cleanup_tempdir(app, exc):
     except Exception:
         pass
 
-def which(program):
-    for path in os.environ["PATH"].split(":"):
-        if os.path.exists(path + "/" + program):
-            return path + "/" + program
-
-    return None
-
 def setup(app):
     app.add_node(dag,
                  html=(html_visit_dag, depart_dag),
-                 latex=(latex_visit_dag, depart_dag))
+                 latex=(latex_visit_dag, depart_dag),
+                 text=(text_visit_dag, depart_dag),
+                 man=(text_visit_dag, depart_dag))
     app.add_node(daginline,
                  html=(html_visit_dag, depart_dag),
-                 latex=(latex_visit_daginline, depart_dag))
+                 latex=(latex_visit_daginline, depart_dag),
+                 text=(text_visit_daginline, depart_dag),
+                 man=(text_visit_daginline, depart_dag))
     app.add_role('dag', dag_role)
     app.add_directive('dag', DagDirective)
     app.add_config_value('dag_latex_preamble', '', 'env')
     app.add_config_value('dag_tikzlibraries', '', 'env')
     app.add_config_value('dag_transparent', True, 'env')
+    # render dags to pdf once and \includegraphics them in latex output
+    # instead of making pdflatex recompile every tikzpicture on every pass
+    app.add_config_value('dag_latex_external', False, 'env')
+    # split dags wider than this many grid columns into separately rendered
+    # tiles (0 means never)
+    app.add_config_value('dag_tile_size', 0, 'env')
+    # number of renders to run at once (0 means one per cpu)
+    app.add_config_value('dag_render_jobs', 0, '')
+    # precompile the preamble (tikz and the dag styles) into a latex format
+    # so that each render starts warm
+    app.add_config_value('dag_latex_format', True, '')
+    # number of latex processes to keep started with that format, waiting
+    # for the next render (0 means every render starts its own)
+    app.add_config_value('dag_latex_workers', 0, '')
+    # a directory of rendered images shared by several builds (e.g. one per
+    # builder or language, or ci machines on a network filesystem), which
+    # take turns so that each image is only rendered once
+    app.add_config_value('dag_cache_dir', '', '')
+    # seconds after which a lock in dag_cache_dir that its build stopped
+    # touching is assumed to be left over from a build that died
+    app.add_config_value('dag_cache_lock_timeout', 600, '')
+    # seconds for which builds sharing dag_cache_dir don't render a dag
+    # again that failed with a latex error (twice) in another build
+    app.add_config_value('dag_cache_failure_ttl', 3600, '')
+    # path of the unix socket of a render service (python asciidag.py serve)
+    # to hand renders to; we render ourselves if it isn't running
+    app.add_config_value('dag_render_socket', '', '')
 
     # this needs to be set early; if the user specifies a preamble in conf.py
     # then this is overwritten
@@ -507,11 +1972,155 @@ def setup(app):
         latex['preamble'] = r'\usepackage{tikz}'
         latex['preamble'] += r'\usetikzlibrary{%s}' % DEFAULT_LIBS
 
-    # fallback to another value depending what is on the system
-    suite = 'pdf2svg'
-    if not which('pdf2svg'):
-        suite = 'Netpbm'
-        if not which('pnmcrop'):
-            suite = 'ImageMagick'
-    app.add_config_value('dag_proc_suite', suite, 'html')
+    # None picks the best of SUITES that is installed, when the first dag
+    # is rendered
+    app.add_config_value('dag_proc_suite', None, 'html')
+    app.connect('builder-inited', resume_renders)
+    app.connect('env-purge-doc', purge_dags)
+    app.connect('env-merge-info', merge_dags)
+    app.connect('env-updated', prerender_dags)
     app.connect('build-finished', cleanup_tempdir)
+
+    # dags are parsed by the directive and role, which only touch the
+    # document they are in, so reading can be done in parallel
+    return {'version': '0.0.1', 'parallel_read_safe': True}
+
+class RenderService(object):
+    '''a render daemon shared by concurrent builds (see serve()). It plays
+    the part of the builder for compile_dag, with its own formats, glyph
+    cache and images kept in statedir.'''
+    def __init__(self, statedir, jobs, workers=0):
+        self.doctreedir = statedir
+        self.imagedir = os.path.join(statedir, 'images')
+        ensuredir(self.imagedir)
+        self.config = ServiceConfig()
+        self.config.dag_latex_workers = workers
+        self.slots = threading.Semaphore(jobs)
+        self.lock = threading.Lock()
+        self.inflight = {}              # key -> Event set when rendered
+        self.failures = {}              # key -> (error message, time)
+
+    def warn(self, msg):
+        sys.stderr.write('WARNING: %s\n' % msg)
+
+    def render(self, job):
+        '''render job (from render_dag, less its outfn) unless it is already
+        rendered or being rendered; return the image's path'''
+        key = json.dumps([job['head'], job['body'], job['fmt'], job['suite'],
+                          job['transparent']])
+        key = sha(key).hexdigest()
+        outfn = os.path.join(self.imagedir, '%s.%s' % (key, job['fmt']))
+        while True:
+            with self.lock:
+                if key in self.failures:
+                    error, when = self.failures[key]
+                    if time.time() - when <= self.config.dag_cache_failure_ttl:
+                        raise DagExtError(error)
+                    del self.failures[key]
+                if os.path.isfile(outfn):
+                    return outfn
+                event = self.inflight.get(key)
+                if event is None:
+                    event = self.inflight[key] = threading.Event()
+                    break
+            # somebody else is rendering it
+            event.wait()
+
+        try:
+            with self.slots:
+                compile_dag(self, dict(job, outfn=outfn))
+        except DagToolError:
+            raise
+        except DagExtError, exc:
+            # only remember what rendering again won't fix (see
+            # cached_compile)
+            if latex_failed(str(exc)):
+                with self.lock:
+                    self.failures[key] = (str(exc), time.time())
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+        return outfn
+
+class ServiceConfig(object):
+    '''the configuration values compile_dag looks at'''
+    dag_latex_format = True
+    dag_latex_workers = 0
+    dag_cache_dir = ''
+    dag_cache_failure_ttl = 3600
+
+def serve(path, statedir, jobs, workers=0):
+    '''run a render service on the unix socket at path until interrupted.
+    Builds with dag_render_socket set to path send it their renders, so
+    that they all share its warm formats and finished images.'''
+    # only the service needs these, so builds don't import them
+    import socket
+    import SocketServer
+
+    class ServiceHandler(SocketServer.StreamRequestHandler):
+        '''one client connection: json requests in, json replies out, one
+        per line'''
+        def handle(self):
+            for line in iter(self.rfile.readline, ''):
+                try:
+                    reply = {'path': self.server.service.render(
+                        json.loads(line)['job'])}
+                except DagToolError, exc:
+                    reply = {'error': str(exc), 'tool': True}
+                except DagExtError, exc:
+                    reply = {'error': str(exc)}
+                except (ValueError, KeyError, TypeError), exc:
+                    reply = {'error': 'bad request: %s' % exc}
+                self.wfile.write(json.dumps(reply) + '\n')
+                self.wfile.flush()
+
+    if os.path.exists(path):
+        # left over from a service that is gone (if it isn't, bind fails
+        # below rather than pulling the socket from under it)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)
+        finally:
+            probe.close()
+    # local builds only: the socket is created without access for anyone
+    # else, rather than chmod()ed once it is already listening
+    umask = os.umask(0077)
+    try:
+        server = SocketServer.ThreadingUnixStreamServer(path, ServiceHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    server.service = RenderService(statedir, jobs, workers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        close_workers(server.service)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Render service for the asciidag sphinx extension.')
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('socket', help='path of the unix socket to listen on')
+    parser.add_argument('statedir', help='where to keep formats and images')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                        help='renders to run at once')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='latex processes to keep waiting for renders')
+    args = parser.parse_args()
+    # clean up the socket when killed, too
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(args.socket, args.statedir, args.jobs, args.workers)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
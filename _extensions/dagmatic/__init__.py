@@ -1 +1,4 @@
-from dagmatic import parse
+from dagmatic import parse, deserialize, EXTENT_SCOPE
+from layout import build
+from nodes import DAGSyntaxError
+from text import text_lines, text_string
@@ -2,18 +2,65 @@
 
 from __future__ import print_function
 
+import json
 import sys
 import re
-import cStringIO
 
-from nodes import TransitionText, Node, Style
-from edges import types
+try:
+    from hashlib import sha1 as sha
+except ImportError:
+    from sha import sha
+
+# numpy, imported by _numpy() once a dag is big enough for it to pay off:
+# False until then, None if it isn't installed
+numpy = False
+# characters of input below which the plain python tokenizer is faster
+# than importing numpy
+NUMPY_MIN_CHARS = 4096
+
+from nodes import TransitionText, Node, Style, DAGSyntaxError
+from edges import types, Marker, VerticalEdge
 
 # We're looking for node labels (runs of alphanumeric chars) and the edges
 # between them. E.g. given a line like "  \ a-b  :", the tokens of interest
-# are \, a, -, b, :. This regex is a good place to start (but now we have
-# two problems).
-nodefind_re = re.compile(r'([a-zA-Z0-9\'^]+)')
+# are \, a, -, b, :. This regex finds all of them: a node or any other
+# non-space char (but now we have two problems).
+token_re = re.compile(r'[a-zA-Z0-9\'^]+|[^ ]')
+
+# version of the layout of DAG.serialize() output
+FORMAT = 2
+
+# the scope of the invisible nodes that stretch a tile to the rows of the
+# whole dag (see DAG.tiles); pictures with them must not be cropped any
+# tighter than their tikz bounding box
+EXTENT_SCOPE = r'\begin{scope}[opacity=0]'
+
+# str.translate() table turning a bytearray of 0/1 flags into '0'/'1' chars
+_flagchars = '01' + ''.join(chr(i) for i in xrange(2, 256))
+
+
+def _bits(flags):
+    '''turn a bytearray of 0/1 flags (one per node index) into a bitset'''
+    return int(str(flags[::-1]).translate(_flagchars) or '0', 2)
+
+
+def _indices(bits):
+    '''yield the node indexes set in a bitset, in order'''
+    digits = bin(bits)[:1:-1]
+    i = digits.find('1')
+    while i != -1:
+        yield i
+        i = digits.find('1', i + 1)
+
+
+def _numpy():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
 
 
 def parse(text):
@@ -22,21 +69,277 @@ def parse(text):
     # First step: turn input lines into a "grid" of character cells.
     # grid[i][j] tells us what is occupying cell (i,j): either a node
     # or a single non-node character.
-    text = text.splitlines()
-    grid = _read_grid(text)
+    return _parse_lines(text.splitlines())
+
+
+def _parse_lines(text):
+    grid, cells = _read_grid(text)
+    nodes = []
+
+    # Now turn the grid into an AST-like thing: the DAGList. Only the cells
+    # that do something are visited (still in row-major order): spacers
+    # parse to nothing, and the rest of a node's cells would repeat its
+    # first one.
+    for (row, col) in cells:
+        grid[row][col].parse(nodes, grid, row, col)
+
+    dag = DAG(node_ids(nodes))
+    # the parser visits nodes in grid order
+    dag._sorted_nodes = nodes
+    # kept for DAG.update()
+    dag._lines = list(text)
+    dag._grid = grid
+    dag._plain = all(isinstance(row, _Row) for row in grid)
+    return dag
+
+
+def node_ids(nodes):
+    '''Map the id (str()) of each of nodes to it. Ids are unique as long as
+    no two nodes with the same name share a grid cell.'''
+    ids = dict((str(node), node) for node in nodes)
+    assert len(ids) == len(nodes), 'duplicate node ids'
+    return ids
+
+
+def deserialize(data):
+    '''Rebuild a DAG from the output of DAG.serialize(). Lists are accepted
+    wherever serialize() returns tuples, so data may have been through JSON.
+    '''
+    (format, styles, names, annotations, coords, flags, stylerefs, edges,
+     markers, elided, transitions, extent, fingerprint) = data
+    if format != FORMAT:
+        raise ValueError('unknown dag format %r' % (format,))
+    styles = [Style(items) for items in styles]
+    styles[0] = {}
     nodes = []
+    for (i, name) in enumerate(names):
+        if flags[i] & 2:
+            node = TransitionText(None)
+        else:
+            node = Node(name)
+        node.annotation = annotations[i]
+        node.row = coords[2 * i]
+        node.col = coords[2 * i + 1]
+        node.obsolete = bool(flags[i] & 1)
+        node._style = styles[stylerefs[i]]
+        nodes.append(node)
+    for i in xrange(0, len(edges), 2):
+        nodes[edges[i]].parents.append(nodes[edges[i + 1]])
+    for i in xrange(0, len(markers), 2):
+        nodes[markers[i]].precursors.append(nodes[markers[i + 1]])
+    for i in xrange(0, len(elided), 3):
+        nodes[elided[i]].elided_parents = elided[i + 1]
+        nodes[elided[i]].elided_children = elided[i + 2]
+    for (i, text, middle) in transitions:
+        nodes[i]._text = text
+        if middle is not None:
+            nodes[i].middle = [nodes[m] if isinstance(m, int) else m
+                               for m in middle]
+
+    dag = DAG(node_ids(nodes))
+    if extent is not None:
+        dag.extent = tuple(extent)
+    # serialize() wrote the nodes in grid order
+    dag._sorted_nodes = nodes
+    dag._fingerprint = fingerprint
+    return dag
+
+
+# Cell type codes for lines of nodes and edges: SPACE, NODE, one per edge
+# character, and BAD for anything else.
+_edgechars = '-|\\/.:<>'
+SPACE = 0
+NODE = 1
+BAD = 255
+_codes = bytearray([BAD]) * 256
+_codes[ord(' ')] = SPACE
+for c in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789\'^':
+    _codes[ord(c)] = NODE
+for (i, c) in enumerate(_edgechars):
+    _codes[ord(c)] = i + 2
+_codecells = [types[' '], None] + [types[c] for c in _edgechars]
+VERTICAL = _codes[ord('|')]
+# str.translate() table turning characters into codes
+_codechars = str(_codes)
+
+
+class _Row(object):
+    '''A grid row of nodes and edges, kept as an array of cell type codes
+    plus the nodes spanning some of them. Cells are looked up on demand, so
+    it reads just like a list of them.'''
+    __slots__ = ('codes', 'owner', 'nodes')
+
+    def __init__(self, codes, owner, nodes):
+        self.codes = codes              # cell type code per column
+        self.owner = owner              # column -> index into nodes
+        self.nodes = nodes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, col):
+        code = self.codes[col]
+        if code == NODE:
+            return self.nodes[self.owner[col]]
+        return _codecells[code]
+
+
+def _raw(line):
+    # one byte per character, so that columns stay put; '?' is BAD
+    if isinstance(line, unicode):
+        line = line.encode('ascii', 'replace')
+    return line
 
-    # Now turn the grid into an AST-like thing: the DAGList.
-    for (row, line) in enumerate(grid):
-        for (col, ch) in enumerate(line):
-            ch.parse(nodes, grid, row, col)
 
-    nodemap = {str(node): node for node in nodes}
-    return DAG(nodemap)
+def _badchar(row, col, line):
+    return DAGSyntaxError(row, col, 'unexpected character %r' % line[col])
+
+
+def _tokenize(grid, plain):
+    '''Fill in grid rows for plain, a list of (row, line) of nodes and
+    edges, in a handful of whole-array passes. Return a mapping from row
+    to the columns that need parsing: edges and the first cell of each
+    node.'''
+    if not plain:
+        return {}
+    lines = [line for (row, line) in plain]
+    width = max(len(line) for line in lines)
+    if not width:
+        return {}
+    height = len(lines)
+    chars = numpy.frombuffer(''.join(_raw(line).ljust(width)
+                                     for line in lines),
+                             dtype=numpy.uint8).reshape(height, width)
+    codes = numpy.frombuffer(_codechars, dtype=numpy.uint8)[chars]
+
+    bad = numpy.argwhere(codes == BAD)
+    if len(bad):
+        i, col = bad[0]
+        raise _badchar(plain[i][0], int(col), lines[i])
+
+    # nodes are runs of NODE cells: mark where each starts and ends
+    isnode = codes == NODE
+    starts = isnode.copy()
+    starts[:, 1:] &= ~isnode[:, :-1]
+    ends = isnode.copy()
+    ends[:, :-1] &= ~isnode[:, 1:]
+    owner = numpy.cumsum(starts.ravel()).reshape(height, width) - 1
+    nodes = [Node(lines[r][s:e + 1])
+             for (r, s, e) in zip(*(numpy.nonzero(starts) +
+                                    (numpy.nonzero(ends)[1],)))]
+
+    rows, cols = numpy.nonzero(starts | (codes > NODE))
+    bounds = numpy.searchsorted(rows, numpy.arange(height + 1)).tolist()
+    cols = cols.tolist()
+    active = {}
+    for (i, (row, line)) in enumerate(plain):
+        # plain Python containers are much faster to index one at a time
+        grid[row] = _Row(bytearray(codes[i, :len(line)].tostring()),
+                         owner[i, :len(line)].tolist(), nodes)
+        active[row] = cols[bounds[i]:bounds[i + 1]]
+    return active
+
+
+def _tokenize_python(grid, plain):
+    '''_tokenize() without NumPy: a translate() and a regex scan per
+    line'''
+    active = {}
+    for (row, line) in plain:
+        codes = bytearray(_raw(line).translate(_codechars))
+        owner = {}
+        nodes = []
+        cols = []
+        for m in token_re.finditer(line):
+            col = m.start()
+            if codes[col] == BAD:
+                raise _badchar(row, col, line)
+            cols.append(col)
+            if codes[col] == NODE:
+                for c in xrange(col, m.end()):
+                    owner[c] = len(nodes)
+                nodes.append(Node(m.group()))
+        grid[row] = _Row(codes, owner, nodes)
+        active[row] = cols
+    return active
+
+
+def _isplain(line):
+    '''whether line is nodes and edges (rather than a transition or a
+    style)'''
+    return not line.lstrip().startswith(('||', '{'))
+
+
+def _edgecols(row):
+    '''columns of the edges on a grid row'''
+    return [col for (col, code) in enumerate(row.codes) if code > NODE]
+
+
+def _rownodes(row):
+    '''the nodes on a grid row, left to right'''
+    codes = row.codes
+    return [row[col] for (col, code) in enumerate(codes)
+            if code == NODE and (col == 0 or codes[col - 1] != NODE)]
+
+
+def _vertical(grid, row):
+    '''whether grid row has any vertical edges, which connect one way or
+    the other depending on what was parsed before them'''
+    return row < len(grid) and VERTICAL in grid[row].codes
+
+
+def _relation(cell, grid, row, col):
+    '''(node, list, node) of the edge cell made when its grid was parsed:
+    the second node is in the named list (parents or precursors) of the
+    first'''
+    parent, child = cell.parsenodes(grid, row, col)
+    if isinstance(cell, Marker):
+        return child, 'precursors', parent
+    if isinstance(cell, VerticalEdge) and child in parent.parents:
+        if parent in child.parents:
+            # it could have gone either way
+            raise _Tangled(row, col)
+        return parent, 'parents', child
+    return child, 'parents', parent
+
+
+class _Tangled(Exception):
+    '''an edge update() can't tell the direction of'''
+
+
+def _first(nodes, row):
+    '''index of the first of nodes (in grid order) on or below row'''
+    lo, hi = 0, len(nodes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if nodes[mid].row < row:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _TikzIds(object):
+    '''tikz names of nodes relative to origin, worked out as they are
+    asked for'''
+    def __init__(self, origin):
+        self.origin = origin
+        self.ids = {}
+
+    def get(self, node, default=None):
+        if not isinstance(node, Node):
+            return default
+        name = self.ids.get(node)
+        if name is None:
+            name = self.ids[node] = node.tikz_id(self.origin)
+        return name
 
 
 def _read_grid(infile):
+    '''Split infile (a sequence of lines) into a grid of cells. Return
+    (grid, cells) where cells lists the (row, col) of every cell worth
+    parsing, in row-major order.'''
     grid = []
+    plain = []                          # (row, line) of nodes and edges
     style = ''
     for line in infile:
         grid.append([])
@@ -61,18 +364,23 @@ def _read_grid(infile):
 
                 style = ''
         else:
-            chunks = nodefind_re.split(line.rstrip())
+            # Must preserve every input char because of the visual nature
+            # of the input language -- need grid[i][j] to be useful!
+            plain.append((len(grid) - 1, line.rstrip()))
 
-            for (idx, chunk) in enumerate(chunks):
-                if idx % 2 == 1:  # must be a node (run of alphanumeric)
-                    node = Node(chunk)
-                    currow += [node] * len(chunk)
-                else:
-                    # Must preserve every input char because of the visual
-                    # nature of the input language -- need grid[i][j] to be
-                    # useful!
-                    currow += [types[c] for c in chunk]
-    return grid
+    if (sum(len(line) for (row, line) in plain) < NUMPY_MIN_CHARS or
+            _numpy() is None):
+        active = _tokenize_python(grid, plain)
+    else:
+        active = _tokenize(grid, plain)
+    cells = []
+    for (row, currow) in enumerate(grid):
+        cols = active.get(row)
+        if cols is None:
+            # transition texts and styles
+            cols = xrange(len(currow))
+        cells.extend((row, col) for col in cols)
+    return grid, cells
 
 
 class DAG(object):
@@ -83,6 +391,22 @@ class DAG(object):
     def __init__(self, nodemap):
         self.nodemap = nodemap              # map node name to Node
         self._nodes = None
+        self._sorted_nodes = None
+        self._fingerprint = None
+        self._graph = None
+        # tikz lines per node, for the dag's current origin
+        self._tikz = {}
+        self._tikz_origin = None
+        # (top, bottom) grid rows to draw the dag as tall as, for tiles
+        self.extent = None
+        # the input lines and grid, if parsed from text (see update())
+        self._lines = None
+        self._grid = None
+        self._plain = False
+
+    def __reduce__(self):
+        # pickle (e.g. into the Sphinx environment) in the compact form
+        return (deserialize, (self.serialize(),))
 
     @property
     def nodes(self):
@@ -112,6 +436,374 @@ class DAG(object):
         return [precursor.name
                 for precursor in self[name].precursors]
 
+    def invalidate(self):
+        '''forget everything computed from the graph; call this after
+        changing nodes, parents or precursors'''
+        self._nodes = None
+        self._sorted_nodes = None
+        self._fingerprint = None
+        self._graph = None
+        self._tikz = {}
+
+    def update(self, start, stop, lines):
+        '''Replace lines start to stop of the text the dag was parsed from
+        with lines (a list, as from splitlines()) and patch the dag to match,
+        just as if the new text had been parsed. Only the new lines and the
+        edges around them are parsed again, so the cost depends on the size
+        of the edit rather than of the dag; dags with transitions or styles
+        are parsed again in full. On a syntax error the dag is left as it
+        was.'''
+        if self._lines is None:
+            raise ValueError('dag was not parsed from text')
+        if not 0 <= start <= stop <= len(self._lines):
+            raise ValueError('bad line range %d:%d' % (start, stop))
+        lines = list(lines)
+        old = self._lines
+        text = old[:start] + lines + old[stop:]
+        if not (self._plain and all(_isplain(line) for line in lines)):
+            self._reparse(text)
+            return
+        new = {}
+        active = _tokenize_python(new, [(start + i, line.rstrip())
+                                        for (i, line) in enumerate(lines)])
+        try:
+            try:
+                self._patch(start, stop, new, active)
+            except _Tangled:
+                self._reparse(text)
+        except Exception:
+            exc = sys.exc_info()
+            self._reparse(old)
+            raise exc[0], exc[1], exc[2]
+        self._lines = text
+
+    def _reparse(self, text):
+        self.__dict__.update(_parse_lines(text).__dict__)
+
+    def _patch(self, start, stop, new, active):
+        '''update() the grid rows start to stop with the rows in new'''
+        grid = self._grid
+        delta = len(new) - (stop - start)
+        order = self.sorted_nodes
+        i = _first(order, start)
+        j = _first(order, stop)
+        old = order[i:j]
+
+        def swap():
+            if delta:
+                for node in order[j:]:
+                    node.row += delta
+            grid[start:stop] = [new[row] for row in sorted(new)]
+            return delta
+
+        # parse the new rows, and the edges either side of them, again;
+        # then as many rows below as that turns around vertical edges in
+        nodes = []
+        precursors = set()
+        lo = max(start - 1, 0)
+        hi, end = self._reband(lo, min(stop + 1, len(grid)), active, nodes,
+                               precursors, swap)
+        while end is not None:
+            hi, end = self._reband(hi, end, active, nodes, precursors)
+
+        # nodes that lost a successor may not be obsolete any more
+        old = set(old)
+        for node in precursors - old:
+            rows = xrange(max(node.row - 2, 0), min(node.row + 3, len(grid)))
+            node.obsolete = node.annotation in ('O', 'T') or any(
+                node in n.precursors for row in rows
+                for n in _rownodes(grid[row]))
+
+        order[i:j] = nodes
+        if delta:
+            self.nodemap = node_ids(order)
+        else:
+            for node in old:
+                del self.nodemap[str(node)]
+            self.nodemap.update(node_ids(nodes))
+            assert len(self.nodemap) == len(order), 'duplicate node ids'
+
+        # tikz lines change for nodes with new edges, and for all those that
+        # moved or have edges to nodes that moved
+        for node in old:
+            self._tikz.pop(node, None)
+        drop = order[_first(order, lo - 2):]
+        if not delta:
+            drop = order[_first(order, lo - 2):_first(order, hi + 2)]
+        for node in drop:
+            self._tikz.pop(node, None)
+        self._nodes = None
+        self._fingerprint = None
+        self._graph = None
+
+    def _reband(self, lo, hi, active, nodes, precursors, swap=None):
+        '''Parse the edges on grid rows lo to hi again, and the nodes on
+        the rows in active, after swap() (if any) has replaced some of them
+        and returned how many rows that moved the rest by. Return the new hi,
+        and the end of the rows below that need parsing again (or None).'''
+        grid = self._grid
+
+        # the edges just below the band came last in the lists of the nodes
+        # they share with it: put them aside to go back after the band's
+        tails = {}
+        for row in xrange(hi, min(hi + 2, len(grid))):
+            for col in _edgecols(grid[row]):
+                node, attr, other = _relation(grid[row][col], grid, row, col)
+                if node.row <= hi:
+                    tails.setdefault((node, attr), []).append(other)
+        for ((node, attr), others) in tails.items():
+            del getattr(node, attr)[-len(others):]
+
+        # a vertical edge goes up or down depending on whether the node
+        # above it has parents yet (see VerticalEdge.connect), which the band
+        # may change for those just below it
+        watch = []
+        for row in (hi, hi + 1):
+            if _vertical(grid, row):
+                watch.extend((node, bool(node.parents), row + 1)
+                             for node in _rownodes(grid[row - 1]))
+
+        for row in xrange(lo, hi):
+            for col in _edgecols(grid[row]):
+                node, attr, other = _relation(grid[row][col], grid, row, col)
+                getattr(node, attr).remove(other)
+                if attr == 'precursors':
+                    precursors.add(other)
+
+        delta = swap() if swap else 0
+        for row in xrange(lo, hi + delta):
+            cols = active.get(row)
+            if cols is None:
+                cols = _edgecols(grid[row])
+            for col in cols:
+                grid[row][col].parse(nodes, grid, row, col)
+
+        end = max([below + delta for (watched, before, below) in watch
+                   if bool(watched.parents) != before] or [None])
+        for ((node, attr), others) in tails.items():
+            getattr(node, attr).extend(others)
+        return hi + delta, end
+
+    def _index(self):
+        '''build (once) the indexes used by graph queries: changesets in
+        grid order, the first changeset with each name, plus parent, child,
+        precursor and successor indexes by position in that order'''
+        if self._graph is None:
+            order = [n for n in self.sorted_nodes
+                     if not isinstance(n, TransitionText)]
+            index = dict((node, i) for (i, node) in enumerate(order))
+            byname = {}
+            parents = {}
+            children = {}
+            precursors = {}
+            successors = {}
+            for (i, node) in enumerate(order):
+                byname.setdefault(node.name, node)
+                # only nodes with edges get an entry; tuples of ints are
+                # cheap to keep around for big graphs
+                if node.parents:
+                    parents[i] = tuple(index[p] for p in node.parents)
+                    for p in parents[i]:
+                        children.setdefault(p, []).append(i)
+                if node.precursors:
+                    precursors[i] = tuple(index[p] for p in node.precursors)
+                    for p in precursors[i]:
+                        successors.setdefault(p, []).append(i)
+            self._graph = {
+                'order': order,
+                'index': index,
+                'byname': byname,
+                'parents': parents,
+                'children': children,
+                'precursors': precursors,
+                'successors': successors,
+                'ancestors': {},            # memoized bitsets
+                'descendants': {},
+            }
+        return self._graph
+
+    def _position(self, name):
+        '''index of the named node in the query order'''
+        graph = self._index()
+        node = self.nodemap.get(name) or graph['byname'].get(name)
+        if node is None:
+            raise KeyError(name)
+        return graph['index'][node]
+
+    def _names(self, bits):
+        order = self._index()['order']
+        return [order[i].name for i in _indices(bits)]
+
+    def _reach(self, i, kind, edges):
+        '''bitset of everything reachable from node index i following
+        edges (including i itself), memoized in graph[kind]'''
+        graph = self._index()
+        cache = graph[kind]
+        if i in cache:
+            return cache[i]
+        edges = graph[edges]
+        flags = bytearray(len(graph['order']))
+        flags[i] = 1
+        bits = 0
+        stack = [i]
+        while stack:
+            for j in edges.get(stack.pop(), ()):
+                if flags[j]:
+                    continue
+                flags[j] = 1
+                if j in cache:
+                    # no need to walk past a node we've already done
+                    bits |= cache[j]
+                else:
+                    stack.append(j)
+        bits |= _bits(flags)
+        cache[i] = bits
+        return bits
+
+    def _union(self, names, kind, edges):
+        bits = 0
+        for name in names:
+            bits |= self._reach(self._position(name), kind, edges)
+        return bits
+
+    def children(self, name):
+        '''return children of specified node as str (node names)'''
+        graph = self._index()
+        return [graph['order'][i].name
+                for i in graph['children'].get(self._position(name), ())]
+
+    def successors(self, name):
+        '''return successors of specified node as str (node names)'''
+        graph = self._index()
+        return [graph['order'][i].name
+                for i in graph['successors'].get(self._position(name), ())]
+
+    def ancestors(self, *names):
+        '''names of the specified nodes and all their ancestors'''
+        return self._names(self._union(names, 'ancestors', 'parents'))
+
+    def descendants(self, *names):
+        '''names of the specified nodes and all their descendants'''
+        return self._names(self._union(names, 'descendants', 'children'))
+
+    def common_ancestors(self, *names):
+        '''names of the nodes that are ancestors of all specified nodes'''
+        bits = -1
+        for name in names:
+            bits &= self._reach(self._position(name), 'ancestors', 'parents')
+        return self._names(bits if names else 0)
+
+    def only(self, names, exclude):
+        '''names of the ancestors of names that are not ancestors of
+        exclude (like Mercurial's only() revset)'''
+        return self._names(self._union(names, 'ancestors', 'parents') &
+                           ~self._union(exclude, 'ancestors', 'parents'))
+
+    def subgraph(self, nodes):
+        '''Return a new DAG with copies of nodes (Node objects from this
+        dag). Edges to nodes that were left out are counted in
+        elided_parents and elided_children, which are drawn as short stubs.
+        Transition texts are only kept if the nodes they hang off are.
+        '''
+        copies = {}
+        transitions = []
+        for node in nodes:
+            if isinstance(node, TransitionText):
+                transitions.append(node)
+            else:
+                copies[node] = node.copy()
+        for node in transitions:
+            middle = getattr(node, 'middle', [])
+            if all(m in copies for m in middle if isinstance(m, Node)):
+                copies[node] = node.copy()
+                copies[node].middle = [copies.get(m, m) for m in middle]
+
+        for node in self.nodemap.values():
+            if isinstance(node, TransitionText):
+                continue
+            child = copies.get(node)
+            for p in node.parents:
+                if child is not None and p in copies:
+                    child.parents.append(copies[p])
+                elif child is not None:
+                    child.elided_parents += 1
+                elif p in copies:
+                    copies[p].elided_children += 1
+            if child is not None:
+                child.precursors = [copies[p] for p in node.precursors
+                                    if p in copies]
+        return DAG(node_ids(copies.values()))
+
+    def around(self, name, depth=1):
+        '''subgraph of the nodes at most depth edges (parents, children,
+        precursors or successors) away from the named node'''
+        graph = self._index()
+        order = graph['order']
+        start = self._position(name)
+        seen = set([start])
+        frontier = [start]
+        for i in xrange(depth):
+            reached = []
+            for j in frontier:
+                for edges in ('parents', 'children', 'precursors',
+                              'successors'):
+                    for k in graph[edges].get(j, ()):
+                        if k not in seen:
+                            seen.add(k)
+                            reached.append(k)
+            frontier = reached
+        return self.subgraph(order[i] for i in seen)
+
+    def between(self, start, stop):
+        '''subgraph of the nodes that are both descendants of start and
+        ancestors of stop (like Mercurial's start::stop)'''
+        order = self._index()['order']
+        bits = (self._union([start], 'descendants', 'children') &
+                self._union([stop], 'ancestors', 'parents'))
+        return self.subgraph(order[i] for i in _indices(bits))
+
+    def window(self, start, stop):
+        '''subgraph of the nodes on grid rows start <= row < stop, i.e.
+        lines start to stop of the ascii input'''
+        return self.subgraph(node for node in self.nodemap.values()
+                             if start <= node.row < stop)
+
+    def tiles(self, width):
+        '''split the dag into subgraphs, each width grid columns wide, from
+        left to right. Transition texts go with the node they hang off.'''
+        col = self.origin[1]
+        buckets = {}
+        for node in self.nodemap.values():
+            anchor = node
+            if isinstance(node, TransitionText):
+                anchor = getattr(node, 'middle', [node])[0]
+                if not isinstance(anchor, Node):
+                    anchor = node
+            buckets.setdefault((anchor.col - col) // width, []).append(node)
+        tiles = [self.subgraph(buckets[k]) for k in sorted(buckets)]
+        # each tile is cropped to its own picture, so give them all the
+        # rows of the whole dag for them to line up side by side
+        rows = [node.row for node in self.nodemap.values()
+                if not isinstance(node, TransitionText)]
+        if rows:
+            for tile in tiles:
+                tile.extent = (min(rows), max(rows))
+        return tiles
+
+    def heads(self):
+        '''names of the nodes without children'''
+        graph = self._index()
+        children = graph['children']
+        return [node.name for (i, node) in enumerate(graph['order'])
+                if i not in children]
+
+    def roots(self):
+        '''names of the nodes without parents'''
+        graph = self._index()
+        parents = graph['parents']
+        return [node.name for (i, node) in enumerate(graph['order'])
+                if i not in parents]
+
     def dump(self, outfile):
         for node in self.nodemap.values():
             parents = ','.join(str(p) for p in node.parents)
@@ -122,28 +814,214 @@ class DAG(object):
             print('%s[%d, %d] -> %s%s' % (node, node.row, node.col, parents,
                                           obs), file=outfile)
 
-    def tikz(self, outfile):
-        # need to do two passes so that all nodes are defined first
-        for node in self.nodemap.values():
-            node.tikz(outfile)
+    @property
+    def sorted_nodes(self):
+        '''nodes in grid order (top to bottom, left to right), so that
+        output is stable no matter how nodemap happens to be ordered'''
+        if self._sorted_nodes is None:
+            self._sorted_nodes = sorted(self.nodemap.values(),
+                                        key=lambda n: (n.row, n.col, n.name))
+        return self._sorted_nodes
 
-        for node in self.nodemap.values():
+    @property
+    def origin(self):
+        '''(row, col) of the top left corner of the dag; output is relative
+        to this so that indentation and leading blank lines don't matter'''
+        if not self.nodemap:
+            return (0, 0)
+        return (min(n.row for n in self.nodemap.values()),
+                min(n.col for n in self.nodemap.values()))
+
+    def tikz_lines(self):
+        '''yield the tikz code for this dag one line at a time (without
+        trailing newlines). The output is canonical: nodes in grid order,
+        edges sorted, and coordinates relative to origin.'''
+        nodes = self.sorted_nodes
+        origin = self.origin
+        if origin != self._tikz_origin:
+            self._tikz = {}
+            self._tikz_origin = origin
+        cache = self._tikz
+        ids = _TikzIds(origin)
+
+        def position(node):
+            return (node.row, node.col, node.name)
+
+        def edges(node):
+            name = ids.get(node)
             # output the edges
-            for p in node.parents:
-                print(r'\draw[edge] (%s) -- (%s);' % (p, node), file=outfile)
+            for p in sorted(node.parents, key=position):
+                yield r'\draw[edge] (%s) -- (%s);' % (ids.get(p, p), name)
 
             # output the obsolete edges
-            for p in node.precursors:
-                print(r'\draw[markeredge] (%s) -- (%s);' % (p, node),
-                      file=outfile)
+            for p in sorted(node.precursors, key=position):
+                yield r'\draw[markeredge] (%s) -- (%s);' % (ids.get(p, p),
+                                                            name)
+
+        for line in self._extent_lines(origin):
+            yield line
+
+        # need to do two passes so that all nodes are defined first; the
+        # lines of each node are kept for next time (see update())
+        for node in nodes:
+            lines = cache.get(node)
+            if lines is None:
+                lines = cache[node] = (list(node.tikz_lines(ids, origin)),
+                                       list(edges(node)))
+            for line in lines[0]:
+                yield line
+
+        for node in nodes:
+            for line in cache[node][1]:
+                yield line
+
+    def _extent_lines(self, origin):
+        '''invisible copies of a node on the top and bottom rows of extent,
+        which make the picture just as tall as one of the whole dag'''
+        if self.extent is None:
+            return
+        model = next((node for node in self.sorted_nodes
+                      if not isinstance(node, TransitionText)), None)
+        if model is None:
+            return
+        yield EXTENT_SCOPE
+        for (name, row) in zip(('top', 'bottom'), self.extent):
+            phantom = model.copy()
+            phantom.row = row
+            for line in phantom.tikz_lines({phantom: name}, origin):
+                yield line
+        yield r'\end{scope}'
+
+    def tikz_libraries(self, styles=None):
+        '''the sorted list of tikz libraries that the tikz output needs:
+        those the nodes use directly, and those of the styles they are
+        drawn with, looked up in styles (a map of style names to lists of
+        libraries)'''
+        styles = styles or {}
+        libs = set()
+        for node in self.nodemap.values():
+            libs.update(node.tikz_libraries)
+            libs.update(styles.get(node.tikz_class, ()))
+        return sorted(libs)
+
+    def tikz(self, outfile):
+        for line in self.tikz_lines():
+            outfile.write(line + '\n')
 
     def tikz_string(self):
-        output = cStringIO.StringIO()
-        self.tikz(output)
-        return output.getvalue()
+        lines = list(self.tikz_lines())
+        lines.append('')
+        return '\n'.join(lines)
+
+    def hexdigest(self):
+        '''hash of the canonical tikz output: two dags that only differ in
+        whitespace have the same digest'''
+        return sha(self.tikz_string().encode('utf-8')).hexdigest()
+
+    def serialize(self):
+        '''Return the dag as flat tuples of strings and ints: per node
+        columns (in grid order) for names, annotations, coordinates, flags
+        and references into a table of distinct styles, then edges,
+        obsolescence markers and elided edge counts as runs of node indexes,
+        the transition texts and the extent. This is much smaller and faster
+        to pickle, marshal or JSON-encode than the graph of Node objects;
+        deserialize() turns it back into a DAG.'''
+        nodes = self.sorted_nodes
+        index = dict((node, i) for (i, node) in enumerate(nodes))
+        styles = [()]                   # 0 is "no style"
+        styleids = {}
+        names = []
+        annotations = []
+        coords = []
+        flags = []
+        stylerefs = []
+        edges = []
+        markers = []
+        elided = []
+        transitions = []
+        for (i, node) in enumerate(nodes):
+            names.append(node.name)
+            annotations.append(node.annotation)
+            coords += (node.row, node.col)
+            transition = isinstance(node, TransitionText)
+            flags.append(int(node.obsolete) | int(transition) << 1)
+
+            # styles are shared between nodes (e.g. global ones), so store
+            # each of them once
+            ref = 0
+            if node._style:
+                ref = styleids.get(id(node._style))
+                if ref is None:
+                    ref = styleids[id(node._style)] = len(styles)
+                    styles.append(tuple(sorted(node._style.items())))
+            stylerefs.append(ref)
+
+            for p in node.parents:
+                edges += (i, index[p])
+            for p in node.precursors:
+                markers += (i, index[p])
+            if node.elided_parents or node.elided_children:
+                elided += (i, node.elided_parents, node.elided_children)
+            if transition:
+                middle = getattr(node, 'middle', None)
+                if middle is not None:
+                    middle = tuple(index.get(m, str(m)) for m in middle)
+                transitions.append((i, node._text, middle))
+
+        return (FORMAT, tuple(styles), tuple(names), tuple(annotations),
+                tuple(coords), tuple(flags), tuple(stylerefs), tuple(edges),
+                tuple(markers), tuple(elided), tuple(transitions),
+                self.extent, self._fingerprint)
+
+    def fingerprint(self):
+        '''structural hash of the dag: labels, annotations, styles, parents,
+        precursors and positions relative to origin, but not node names or
+        whitespace. Dags with the same fingerprint render identically.'''
+        if self._fingerprint is None:
+            nodes = self.sorted_nodes
+            row, col = self.origin
+            index = dict((node, i) for (i, node) in enumerate(nodes))
+            lines = []
+            for node in nodes:
+                style = sorted((k, v) for (k, v) in node._style.items()
+                               if k not in ('node', 'text'))
+                # json rather than repr, so that str and unicode labels
+                # (e.g. from a JSON copy of the dag) hash the same
+                lines.append(json.dumps((
+                    node.__class__.__name__,
+                    node.row - row,
+                    node.col - col,
+                    node.text,
+                    node.annotation,
+                    node.obsolete,
+                    node.elided_parents,
+                    node.elided_children,
+                    style,
+                    sorted(index[p] for p in node.parents),
+                    sorted(index[p] for p in node.precursors),
+                    [index.get(m, str(m)) for m in getattr(node, 'middle', [])],
+                )))
+            if self.extent is not None:
+                lines.append(json.dumps(('extent', self.extent[0] - row,
+                                         self.extent[1] - row)))
+            text = '\n'.join(lines)
+            self._fingerprint = sha(text.encode('utf-8')).hexdigest()
+        return self._fingerprint
 
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Parse a dag from stdin and dump its nodes.')
+    parser.add_argument('--text', action='store_true',
+                        help='draw it with box-drawing characters instead')
+    parser.add_argument('--ascii', action='store_true',
+                        help='draw it with ascii characters instead')
+    args = parser.parse_args()
     dag = parse(sys.stdin.read())
+    if args.text or args.ascii:
+        import text
+        sys.stdout.write(text.text_string(dag, args.ascii).encode('utf-8'))
+        return
     print('dag:')
     dag.dump(sys.stdout)
 
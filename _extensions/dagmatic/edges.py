@@ -115,7 +115,7 @@ class LowerDiagonalEdge(Edge):
                                        '%s start on last line' % self)
         elif col == 0:
             raise nodes.DAGSyntaxError(row, col, '%s start of line' % self)
-        elif col >= len(grid[row + 1]):
+        elif col + 1 >= len(grid[row + 1]):
             raise nodes.DAGSyntaxError(row, col,
                                        '%s points past end of next line'
                                        % self)
@@ -144,7 +144,7 @@ class UpperDiagonalEdge(Edge):
         elif col == 0:
             raise nodes.DAGSyntaxError(row, col,
                                        '%s start of line' % self)
-        elif col >= len(grid[row - 1]):
+        elif col + 1 >= len(grid[row - 1]):
             raise nodes.DAGSyntaxError(row, col,
                                        '%s points past end of next line'
                                        % self)
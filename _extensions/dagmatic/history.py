@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+'''Import repository history from log output into a DAG.
+
+Each input line describes one changeset: its id followed by the ids of its
+parents, optionally followed by ``|`` and the ids of its precursors::
+
+  git log --format='%h %p'
+  hg log -T '{node|short} {p1node|short} {p2node|short}\n'
+  hg log --hidden -T '{node|short} {p1node|short} {p2node|short} | \
+{predecessors % "{node|short} "}\n'
+
+Lines must come newest first (the default for both tools). Mercurial's null
+revision (all zeros, or -1 when using revision numbers) is ignored, as are
+blank lines.
+'''
+
+from __future__ import print_function
+
+import sys
+
+import layout
+
+
+def _ids(text):
+    return [i for i in text.split()
+            if i != '-1' and (len(i) == 1 or i.strip('0'))]
+
+
+def read(infile, limit=None, ancestors=None):
+    '''Read log lines from infile (any iterable of lines, e.g. a file or a
+    pipe) in a single pass. Return (parents, precursors) mappings suitable
+    for layout.build().
+
+    If limit is given, stop after that many changesets. If ancestors is
+    given, only keep that changeset and its ancestors. Edges to changesets
+    that were left out are dropped.
+    '''
+    parents = {}
+    precursors = {}
+    wanted = None
+    if ancestors is not None:
+        wanted = set([ancestors])
+
+    for line in infile:
+        if limit is not None and len(parents) >= limit:
+            break
+        if wanted is not None and not wanted:
+            # every ancestor has been seen
+            break
+        line, sep, precs = line.partition('|')
+        ids = _ids(line)
+        if not ids:
+            continue
+        node = ids[0]
+        if wanted is not None:
+            if node not in wanted:
+                continue
+            wanted.discard(node)
+            wanted.update(ids[1:])
+        parents[node] = ids[1:]
+        precs = _ids(precs)
+        if precs:
+            precursors[node] = precs
+
+    # drop edges leading out of the window
+    for node in parents:
+        parents[node] = [p for p in parents[node] if p in parents]
+    for node in precursors:
+        precursors[node] = [p for p in precursors[node] if p in parents]
+    return parents, precursors
+
+
+def parse(infile, limit=None, ancestors=None):
+    '''Read log lines from infile and return a laid out DAG.'''
+    return layout.build(*read(infile, limit=limit, ancestors=ancestors))
+
+
+def main():
+    dag = parse(sys.stdin)
+    dag.tikz(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
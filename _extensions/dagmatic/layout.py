@@ -0,0 +1,142 @@
+'''Build DAGs from graph data instead of ASCII art, and lay them out.
+
+The layout is a simple layered (Sugiyama-style) one that follows the same
+conventions as the ASCII input language: history goes left-to-right, so
+each node's column is its layer (the length of the longest path from a
+root), and nodes within a layer are stacked top-to-bottom. Nodes are two
+cells apart, just like in ``a-b``.
+'''
+
+import nodes
+from dagmatic import DAG, node_ids
+
+# number of ordering sweeps (alternating left-to-right and right-to-left)
+# used to reduce edge crossings
+SWEEPS = 4
+
+
+def build(parents, precursors=None):
+    '''Return a laid out DAG given parents, a mapping from node name to a
+    list of parent names, and optionally precursors, a mapping from node
+    name to a list of precursor names. Nodes only mentioned as a parent or
+    precursor are created as well.
+    '''
+    precursors = precursors or {}
+    nodemap = {}
+    order = []
+
+    def get(name):
+        node = nodemap.get(name)
+        if node is None:
+            node = nodemap[name] = nodes.Node(name)
+            order.append(node)
+        return node
+
+    for name in parents:
+        child = get(name)
+        for p in parents[name]:
+            child.parents.append(get(p))
+    for name in precursors:
+        succ = get(name)
+        for p in precursors[name]:
+            prec = get(p)
+            succ.precursors.append(prec)
+            prec.obsolete = True
+
+    layout(order)
+    return DAG(node_ids(order))
+
+
+def layout(nodelist):
+    '''Assign row and col to every node in nodelist, which must be closed
+    under parents. Raise ValueError if the parent graph has a cycle.
+    '''
+    layers = _layers(nodelist)
+    _order(layers)
+    _place(layers)
+
+
+def _layers(nodelist):
+    '''longest-path layering: every node goes one layer to the right of its
+    rightmost parent. Returns a list of layers (lists of nodes).'''
+    children = dict((node, []) for node in nodelist)
+    pending = {}
+    for node in nodelist:
+        pending[node] = len(node.parents)
+        for p in node.parents:
+            children[p].append(node)
+
+    layer = {}
+    queue = [node for node in nodelist if not node.parents]
+    for node in queue:
+        layer[node] = 0
+    # queue grows while we walk it (Kahn's algorithm)
+    for node in queue:
+        for c in children[node]:
+            layer[c] = max(layer.get(c, 0), layer[node] + 1)
+            pending[c] -= 1
+            if not pending[c]:
+                queue.append(c)
+
+    if len(queue) != len(nodelist):
+        cycle = [str(n.name) for n in nodelist if pending[n]]
+        raise ValueError('cycle in parents involving %s' % ', '.join(cycle))
+
+    layers = [[] for i in xrange(max(layer.values()) + 1)] if layer else []
+    for node in queue:
+        layers[layer[node]].append(node)
+    return layers
+
+
+def _order(layers):
+    '''reduce edge crossings with the barycenter heuristic: repeatedly sort
+    each layer by the mean position of its neighbours in the layers already
+    visited, sweeping left-to-right then right-to-left'''
+    position = {}
+    for nodelist in layers:
+        for (i, node) in enumerate(nodelist):
+            position[node] = i
+
+    children = {}
+    for nodelist in layers:
+        for node in nodelist:
+            for p in node.parents:
+                children.setdefault(p, []).append(node)
+
+    def sweep(layers, neighbours):
+        for nodelist in layers:
+            def barycenter(node):
+                adjacent = neighbours(node)
+                if not adjacent:
+                    return position[node]
+                return (sum(position[n] for n in adjacent) /
+                        float(len(adjacent)))
+            # sort is stable, so ties keep their previous order
+            nodelist.sort(key=barycenter)
+            for (i, node) in enumerate(nodelist):
+                position[node] = i
+
+    for i in xrange(SWEEPS):
+        if i % 2 == 0:
+            sweep(layers[1:], lambda node: node.parents)
+        else:
+            sweep(reversed(layers[:-1]),
+                  lambda node: children.get(node, ()))
+
+
+def _place(layers):
+    '''turn layer and order into grid coordinates, keeping each node as
+    close as possible to the row of its parents so that chains of history
+    come out as straight lines, but never taller than the widest layer'''
+    height = max(len(nodelist) for nodelist in layers) if layers else 0
+    for (i, nodelist) in enumerate(layers):
+        lane = -1
+        for (j, node) in enumerate(nodelist):
+            want = lane + 1
+            if node.parents:
+                rows = sorted(p.row for p in node.parents)
+                want = max(want, rows[(len(rows) - 1) // 2] // 2)
+            # leave room for the rest of this layer
+            lane = min(want, height - len(nodelist) + j)
+            node.row = lane * 2
+            node.col = i * 2
@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import copy
+
 
 class DAGSyntaxError(Exception):
     def __init__(self, row, col, msg):
@@ -11,6 +13,9 @@ class DAGSyntaxError(Exception):
 
 
 class Node(object):
+    # tikz libraries the tikz output needs, besides those of its style
+    tikz_libraries = ()
+
     def __init__(self, name):
         self.name = name
         self._text = None
@@ -21,6 +26,9 @@ class Node(object):
         self.col = -1
         self.obsolete = False
         self._style = {}
+        # edges to nodes left out of a subgraph
+        self.elided_parents = 0
+        self.elided_children = 0
 
         if '^' in name:
             self.name, self.annotation = name.split('^', 1)
@@ -29,7 +37,9 @@ class Node(object):
             self.obsolete = True
 
     def __str__(self):
-        return self.name + str(self.row * 10 + self.col)
+        # the separators keep ids unique: run together, '1' at (1, 2) and
+        # '11' at (0, 2) would both be '112'
+        return '%s_%d_%d' % (self.name, self.row, self.col)
 
     def __repr__(self):
         return '<Node: %s>' % (self.name,)
@@ -42,30 +52,68 @@ class Node(object):
                 self._text = self._style['text']
         return self._text
 
+    def copy(self):
+        '''shallow copy of this node without any edges'''
+        node = copy.copy(self)
+        node.parents = []
+        node.precursors = []
+        node.elided_parents = 0
+        node.elided_children = 0
+        return node
+
     def parse(self, nodes, grid, row, col):
         # set the grid location into the node, if not already set
         if self.row == -1:
             self.row = row
         if self.col == -1:
             self.col = col
-        if self not in nodes:
-            nodes.append(self)
+        # the parser only visits the first cell of each node, so there's
+        # no need for a (slow, with many nodes) membership test
+        nodes.append(self)
 
     def tikz(self, outfile):
+        for line in self.tikz_lines():
+            print(line, file=outfile)
+
+    def tikz_id(self, origin=(0, 0)):
+        '''name of this node in tikz output, relative to origin (the top
+        left corner of the dag) so that it doesn't depend on indentation'''
+        return '%s_%d_%d' % (self.name, self.row - origin[0],
+                             self.col - origin[1])
+
+    @property
+    def tikz_class(self):
+        '''the tikz style this node is drawn with'''
         obs = ''
         if self.obsolete:
             obs = 'obs'
         if self.annotation == 'T':
             obs = 'tmp'
+        return self._style.get('class') or obs + 'changeset'
+
+    def tikz_lines(self, ids=None, origin=(0, 0)):
+        '''yield the tikz code for this node; ids maps nodes to their
+        precomputed tikz names'''
+        cls = self.tikz_class
+        name = (ids or {}).get(self, self)
 
-        cls = self._style.get('class') or obs + 'changeset'
+        yield r'\node[%s] at (%d,%d) (%s) {%s};' % (cls,
+                                                   self.col - origin[1],
+                                                   origin[0] - self.row,
+                                                   name, self.text)
 
-        print(r'\node[%s] at (%d,%d) (%s) {%s};' % (cls, self.col, -self.row,
-                                                    self, self.text),
-              file=outfile)
+        # stubs hinting at history outside of a subgraph
+        if self.elided_parents:
+            yield r'\draw[elidededge] (%s.west) ++(-1,0) -- (%s.west);' % (
+                name, name)
+        if self.elided_children:
+            yield r'\draw[elidededge] (%s.east) -- ++(1,0);' % (name,)
 
 
 class TransitionText(Node):
+    # for the Latex arrow tip and the ($...$) coordinates
+    tikz_libraries = ('arrows.meta', 'calc')
+
     def __init__(self, text):
         super(TransitionText, self).__init__('t')
         self._text = text
@@ -100,28 +148,29 @@ class TransitionText(Node):
             if not isinstance(self.middle, Node):
                 self.middle = [longrow[c / 2 - 1], longrow[c / 2 + 1]]
 
-    def tikz(self, outfile):
-        anchor = r'($(%s.south)$)' % self.middle[0]
-        if len(self.middle) > 1:
-            anchor = r'$.5*(%s.south) + .5*(%s.south)$' % (self.middle[0],
-                                                           self.middle[1])
+    def tikz_lines(self, ids=None, origin=(0, 0)):
+        ids = ids or {}
+        row = self.row - origin[0]
+        middle = [ids.get(m, m) for m in self.middle]
+        anchor = r'($(%s.south)$)' % middle[0]
+        if len(middle) > 1:
+            anchor = r'$.5*(%s.south) + .5*(%s.south)$' % (middle[0],
+                                                           middle[1])
 
         lines = self.text.splitlines()
         # the first line is a command, the rest are subtexts
         lines[0] = r'\small{\texttt{%s}}' % lines[0]
         for i in xrange(1, len(lines)):
             lines[i] = r'\scriptsize\emph{%s}' % lines[i]
-        print('\\draw[line width=5pt, -{Latex[length=7mm]}, draw=gray!80] '
-              '(%s,%.2f) -- node[midway, anchor=west, align=left] (%s) {%s} '
-              '++(0,%.2f);' % (anchor, -(self.row - 1), self,
-                               '\\\\'.join(lines), -(len(lines) + 1.5)),
-              file=outfile)
+        yield ('\\draw[line width=5pt, -{Latex[length=7mm]}, draw=gray!80] '
+               '(%s,%.2f) -- node[midway, anchor=west, align=left] (%s) {%s} '
+               '++(0,%.2f);' % (anchor, -(row - 1), ids.get(self, self),
+                                '\\\\'.join(lines), -(len(lines) + 1.5)))
 
         # print second arrow ontop of the first to produce an outlined arrow
-        print('\\draw [line width=3pt, -{Latex[length=5mm]}, draw=white] '
-              '(%s,%.2f) -- ++(0,%.2f);' % (anchor, -(self.row - 1),
-                                            -(len(lines) + 1.35)),
-              file=outfile)
+        yield ('\\draw [line width=3pt, -{Latex[length=5mm]}, draw=white] '
+               '(%s,%.2f) -- ++(0,%.2f);' % (anchor, -(row - 1),
+                                             -(len(lines) + 1.35)))
 
 
 class Style(dict):
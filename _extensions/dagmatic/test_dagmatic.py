@@ -1,6 +1,14 @@
+import json
+import pickle
+import re
+
 import nose.tools as nt
 
 import dagmatic
+import layout
+import nodes
+import history
+import text
 
 
 def test_readme_1_simple():
@@ -115,6 +123,486 @@ def test_diagonal_obsolete_markers():
     _assert_obsolete(dag, ['a', 'b', 'c'])
 
 
+def test_syntax_errors():
+    for (input, row, col) in [('a-', 0, 1),
+                              ('a-b\n \\\n-c', 1, 1),
+                              (' b\n /\na', 1, 1)]:
+        with nt.assert_raises(nodes.DAGSyntaxError) as cm:
+            dagmatic.parse(input)
+        nt.assert_equal((cm.exception.row, cm.exception.col), (row, col))
+
+
+def test_tokenizers():
+    # the NumPy tokenizer (if installed) and the pure Python one agree
+    inputs = [r'''
+a-b-3-x
+ \ \
+  c-1-f-5
+        :
+        6-7-8
+''', r'''
+      f
+      |
+    d-e
+   /
+  a-b-c^T
+   <:>
+    b'
+{node: b, class: bugnode}
+''', u'''
+  a-b
+
+  || hg commit --amend
+
+  a-b.c
+   \\:
+    b'
+''']
+    numpy = dagmatic._numpy()
+    minchars = dagmatic.NUMPY_MIN_CHARS
+    results = []
+    try:
+        dagmatic.NUMPY_MIN_CHARS = 0
+        for dagmatic.numpy in set([numpy, None]):
+            results.append([_parse_one(input).tikz_string()
+                            for input in inputs])
+            with nt.assert_raises(nodes.DAGSyntaxError) as cm:
+                _parse_one(u'a-b\n\n  c\t-d\u2192')
+            nt.assert_equal((cm.exception.row, cm.exception.col), (2, 3))
+    finally:
+        dagmatic.numpy = numpy
+        dagmatic.NUMPY_MIN_CHARS = minchars
+    nt.assert_equal(results[0], results[-1])
+
+
+def test_tikz_lines():
+    input = r'''
+  c
+  |
+a-b
+'''
+    dag = _parse_one(input)
+    lines = list(dag.tikz_lines())
+    nt.assert_equal(dag.tikz_string(), '\n'.join(lines) + '\n')
+    # nodes come first, in grid order, then the edges
+    nt.assert_true(lines[0].endswith('{c};'))
+    nt.assert_true(lines[1].endswith('{a};'))
+    nt.assert_true(lines[2].endswith('{b};'))
+    nt.assert_equal(lines[3:], [r'\draw[edge] (b_2_2) -- (c_0_2);',
+                                r'\draw[edge] (a_2_0) -- (b_2_2);'])
+
+
+def test_text_lines():
+    dag = _parse_one(r'''
+  a-b
+
+  || hg commit --amend
+  || (safe)
+
+  a-b-c^T
+   \:>
+    d
+{node: d, text: dee}
+''')
+    nt.assert_equal(list(text.text_lines(dag, ascii=True)), [
+        'a---b',
+        '',
+        '  || hg commit --amend',
+        '     (safe)',
+        '',
+        'a-+-b-----c^T',
+        '  | :     :',
+        '  +-dee...+',
+    ])
+    nt.assert_equal(text.text_string(_parse_one('a-b')),
+                    u'a\u2500\u2500\u2500b\n')
+    # an upper diagonal comes up from the parent's row
+    nt.assert_equal(list(text.text_lines(_parse_one(r'''
+  b
+ /
+c-d
+'''), ascii=True)), ['  +-b', '  |', 'c-+-d'])
+
+
+def test_canonical_tikz():
+    input1 = r'''
+a-b-c
+   \:
+    d
+'''
+    input2 = r'''
+
+
+      a-b-c
+         \:
+          d
+'''
+    dag1 = _parse_one(input1)
+    dag2 = _parse_one(input2)
+    nt.assert_equal(dag1.origin, (1, 0))
+    nt.assert_equal(dag2.origin, (3, 6))
+    nt.assert_equal(dag1.tikz_string(), dag2.tikz_string())
+    nt.assert_equal(dag1.hexdigest(), dag2.hexdigest())
+    nt.assert_not_equal(dag1.hexdigest(), _parse_one('a-b').hexdigest())
+
+
+def test_tikz_libraries():
+    styles = {'tmpchangeset': ['decorations.markings'], 'poof': ['shapes']}
+    nt.assert_equal(_parse_one('a-b').tikz_libraries(styles), [])
+    nt.assert_equal(_parse_one('a-b^T').tikz_libraries(styles),
+                    ['decorations.markings'])
+    nt.assert_equal(_parse_one('a-b^T').tikz_libraries(), [])
+    dag = _parse_one(r'''
+  a-b
+
+  || hg commit
+
+  a-b-p
+{node: p, class: poof}
+''')
+    nt.assert_equal(dag.tikz_libraries(styles),
+                    ['arrows.meta', 'calc', 'shapes'])
+
+
+def test_fingerprint():
+    dag = _parse_one(r'''
+a-b
+ \
+  c
+''')
+    # renaming nodes doesn't change the picture if the text stays the same
+    renamed = _parse_one(r'''
+  x-y
+   \
+    z
+{node: x, text: a}
+{node: y, text: b}
+{node: z, text: c}
+''')
+    nt.assert_equal(dag.fingerprint(), renamed.fingerprint())
+    nt.assert_not_equal(dag.hexdigest(), renamed.hexdigest())
+
+    styled = _parse_one(r'''
+a-b
+ \
+  c
+{node: c, class: bugnode}
+''')
+    obsolete = _parse_one(r'''
+a-b
+ \:
+  c
+''')
+    moved = _parse_one(r'''
+a-b
+   \
+    c
+''')
+    fingerprints = set([dag.fingerprint(), styled.fingerprint(),
+                        obsolete.fingerprint(), moved.fingerprint()])
+    nt.assert_equal(len(fingerprints), 4)
+
+
+def test_serialize():
+    input = r'''
+  a-b
+
+  || hg commit --amend
+
+  a-b.c^T
+   \:
+    b'
+{node: global, class: bugnode}
+'''
+    for dag in (_parse_one(input), _parse_one(input).around('c')):
+        data = dag.serialize()
+        for copy in (dagmatic.deserialize(data),
+                     dagmatic.deserialize(json.loads(json.dumps(data))),
+                     pickle.loads(pickle.dumps(dag, 2))):
+            nt.assert_equal(copy.tikz_string(), dag.tikz_string())
+            nt.assert_equal(copy.fingerprint(), dag.fingerprint())
+            nt.assert_items_equal(copy.nodes, dag.nodes)
+            for name in dag.nodes:
+                _assert_parents(copy, name, dag.get_parent_names(name))
+                _assert_precursors(copy, name,
+                                   dag.get_precursor_names(name))
+            nt.assert_equal(copy.serialize()[:-1], data[:-1])
+    # the shared style is only stored once
+    nt.assert_equal(len(data[1]), 2)
+
+
+def test_update():
+    input = r'''
+a-b-c-d
+ \  |
+  e f.g
+    |
+    h-i
+'''
+    dag = _parse_one(input)
+    lines = input.splitlines()
+    dag.tikz_string()
+    edits = [
+        # a marker becomes an edge, so f is no longer obsolete
+        (3, 4, ['  e f-g']),
+        # c loses its parent, which turns the vertical edges below it around
+        (1, 2, ['a-b c-d']),
+        # lines come and go
+        (4, 4, ['    |', '    j']),
+        (1, 3, ['x-y', ' \\']),
+        (0, 7, []),
+    ]
+    for (start, stop, new) in edits:
+        lines[start:stop] = new
+        dag.update(start, stop, new)
+        expect = _parse_one('\n'.join(lines))
+        nt.assert_equal(dag.serialize()[:-1], expect.serialize()[:-1])
+        nt.assert_equal(dag.tikz_string(), expect.tikz_string())
+        nt.assert_equal(dag.fingerprint(), expect.fingerprint())
+        nt.assert_items_equal(dag.nodemap, expect.nodemap)
+
+    dag = _parse_one(input)
+    tikz = dag.tikz_string()
+    with nt.assert_raises(nodes.DAGSyntaxError):
+        dag.update(3, 4, ['  e f-g-'])
+    nt.assert_equal(dag.tikz_string(), tikz)
+    _assert_obsolete(dag, ['f'])
+
+    # transitions are parsed again in full
+    dag.update(6, 6, ['', '  || hg amend', '', '  a-b'])
+    nt.assert_equal(dag.serialize()[:-1],
+                    _parse_one(input + '\n  || hg amend\n\n  a-b\n')
+                    .serialize()[:-1])
+    data = dag.serialize()
+    nt.assert_raises(ValueError, dagmatic.deserialize(data).update, 0, 0, [])
+
+
+def test_queries():
+    input = r'''
+a-b-3-x
+ \ \
+  c-1-f-5
+        :
+        6-7-8
+'''
+    dag = _parse_one(input)
+    nt.assert_items_equal(dag.children('b'), ['3', '1'])
+    nt.assert_items_equal(dag.successors('5'), ['6'])
+    nt.assert_items_equal(dag.successors('6'), [])
+    nt.assert_items_equal(dag.ancestors('1'), ['a', 'b', 'c', '1'])
+    nt.assert_items_equal(dag.ancestors('1', 'x'),
+                          ['a', 'b', 'c', '1', '3', 'x'])
+    nt.assert_items_equal(dag.descendants('c'), ['c', '1', 'f', '5'])
+    nt.assert_items_equal(dag.common_ancestors('x', '5'), ['a', 'b'])
+    nt.assert_items_equal(dag.only(['5'], ['x']), ['c', '1', 'f', '5'])
+    nt.assert_items_equal(dag.heads(), ['x', '5', '8'])
+    nt.assert_items_equal(dag.roots(), ['a', '6'])
+    # memoized results are reused, and thrown away on invalidate()
+    nt.assert_items_equal(dag.ancestors('f'), ['a', 'b', 'c', '1', 'f'])
+    dag['f'].parents = []
+    nt.assert_items_equal(dag.ancestors('f'), ['a', 'b', 'c', '1', 'f'])
+    dag.invalidate()
+    nt.assert_items_equal(dag.ancestors('f'), ['f'])
+    nt.assert_items_equal(dag.roots(), ['a', 'f', '6'])
+
+
+def test_subgraph():
+    input = r'''
+a-b-3-x
+ \ \
+  c-1-f-5
+        :
+        6-7-8
+'''
+    dag = _parse_one(input)
+    sub = dag.around('1')
+    nt.assert_items_equal(sub.nodes, ['b', 'c', '1', 'f'])
+    _assert_parents(sub, '1', ['b', 'c'])
+    _assert_parents(sub, 'b', [])
+    nt.assert_equal(sub['b'].elided_parents, 1)
+    nt.assert_equal(sub['b'].elided_children, 1)
+    nt.assert_equal(sub['f'].elided_children, 1)
+    nt.assert_equal(sub['1'].elided_parents, 0)
+    # the original is untouched
+    _assert_parents(dag, 'b', ['a'])
+    nt.assert_equal(dag['b'].elided_parents, 0)
+
+    nt.assert_items_equal(dag.around('5', depth=2).nodes,
+                          ['1', 'f', '5', '6', '7'])
+    _assert_precursors(dag.around('5'), '6', ['5'])
+
+    sub = dag.between('b', '5')
+    nt.assert_items_equal(sub.nodes, ['b', '1', 'f', '5'])
+
+    sub = dag.window(3, 6)
+    nt.assert_items_equal(sub.nodes, ['c', '1', 'f', '5', '6', '7', '8'])
+    _assert_precursors(sub, '6', ['5'])
+    nt.assert_equal(sub['c'].elided_parents, 1)
+    lines = sub.tikz_string().splitlines()
+    nt.assert_true(r'\draw[elidededge] (c_0_0.west) ++(-1,0) -- '
+                   r'(c_0_0.west);' in lines)
+    nt.assert_true(r'\draw[elidededge] (1_0_2.west) ++(-1,0) -- '
+                   r'(1_0_2.west);' in lines)
+
+
+def test_tiles():
+    input = r'''
+a-b-3-x
+ \ \
+  c-1-f-5
+        :
+        6-7-8
+'''
+    dag = _parse_one(input)
+    tiles = dag.tiles(4)
+    nt.assert_equal([sorted(t.nodes) for t in tiles],
+                    [['a', 'b', 'c'], ['1', '3', 'f', 'x'],
+                     ['5', '6', '7'], ['8']])
+    nt.assert_equal(tiles[1]['1'].elided_parents, 2)
+    nt.assert_equal(tiles[1]['f'].elided_children, 1)
+    nt.assert_equal(len(dag.tiles(100)), 1)
+
+
+def test_tiles_extent():
+    # the first columns go from the top row down, the others start lower
+    input = r'''
+a-b
+ \ \
+  c d-e-f
+     \
+      g-h
+'''
+    dag = _parse_one(input)
+    tiles = dag.tiles(4)
+    nt.assert_equal([sorted(t.nodes) for t in tiles],
+                    [['a', 'b', 'c'], ['d', 'e', 'g'], ['f', 'h']])
+    nt.assert_equal([t.origin[0] for t in tiles], [1, 3, 3])
+    for tile in tiles:
+        nt.assert_equal(tile.extent, (1, 5))
+        lines = tile.tikz_string().splitlines()
+        nt.assert_equal(lines[0], dagmatic.EXTENT_SCOPE)
+        # the invisible nodes put the top row of every tile at the top row
+        # of the dag, wherever its own nodes start
+        ys = [int(re.search(r' at \(\d+,(-?\d+)\)', line).group(1))
+              for line in lines if '(top)' in line or '(bottom)' in line]
+        nt.assert_equal([tile.origin[0] - y for y in ys], [1, 5])
+        copy = dagmatic.deserialize(json.loads(json.dumps(tile.serialize())))
+        nt.assert_equal(copy.tikz_string(), tile.tikz_string())
+    # which makes it a different picture from the nodes on their own
+    plain = dag.subgraph([dag[name] for name in tiles[2].nodes])
+    nt.assert_equal(plain.extent, None)
+    nt.assert_not_equal(plain.fingerprint(), tiles[2].fingerprint())
+
+
+def test_build():
+    dag = layout.build({'b': ['a'], 'c': ['b'], 'd': ['b'], 'e': ['d', 'c']},
+                       precursors={'d': ['c']})
+    nt.assert_items_equal(dag.nodes, ['a', 'b', 'c', 'd', 'e'])
+    _assert_parents(dag, 'a', [])
+    _assert_parents(dag, 'e', ['c', 'd'])
+    _assert_precursors(dag, 'd', ['c'])
+    _assert_obsolete(dag, ['c'])
+    # history goes left to right, one layer per generation
+    nt.assert_equal([dag[n].col for n in 'abcde'], [0, 2, 4, 4, 6])
+    # the main line stays straight, the branch goes below it
+    nt.assert_equal([dag[n].row for n in 'abce'], [0, 0, 0, 0])
+    nt.assert_equal(dag['d'].row, 2)
+    nt.assert_true(dag.tikz_string())
+
+
+def test_numeric_names():
+    # '11' at (0, 2) and '1' at (1, 2) used to share an id
+    dag = _parse_one('  11-3\n  1')
+    nt.assert_items_equal(dag.nodes, ['11', '3', '1'])
+    nt.assert_equal(len(set(line.split('(')[1] for line in dag.tikz_lines()
+                            if line.startswith(r'\node'))), 3)
+    _assert_parents(dag, '3', ['11'])
+    # as did '11' at (0, 2) and '1' at (0, 12) once laid out
+    chain = ['a', '11', 'b', 'c', 'd', 'e', '1']
+    dag = layout.build(dict(zip(chain[1:], [[p] for p in chain])))
+    nt.assert_equal((dag['11'].col, dag['1'].col), (2, 12))
+    nt.assert_items_equal(dag.nodes, chain)
+    _assert_parents(dag, '1', ['e'])
+
+
+def test_build_longest_path():
+    dag = layout.build({'b': ['a'], 'c': ['b'], 'd': ['a', 'c']})
+    nt.assert_equal(dag['d'].col, 6)
+
+
+def test_build_crossings():
+    # without reordering, x's child would sit above y's and the edges cross
+    dag = layout.build({'x': [], 'y': [], 'y1': ['y'], 'x1': ['x'],
+                        'y2': ['y1'], 'x2': ['x1']})
+    for n in ('x1', 'x2'):
+        nt.assert_equal(dag[n].row, dag['x'].row)
+    for n in ('y1', 'y2'):
+        nt.assert_equal(dag[n].row, dag['y'].row)
+
+
+def test_build_cycle():
+    nt.assert_raises(ValueError, layout.build, {'a': ['b'], 'b': ['a']})
+
+
+HGLOG = '''\
+f3 e2 000000000000 | e3
+e3 d1 000000000000
+e2 d1 000000000000
+d1 b1 c1
+c1 a1 000000000000
+b1 a1 000000000000
+
+a1 000000000000 000000000000
+'''
+
+
+def test_history():
+    dag = history.parse(HGLOG.splitlines())
+    nt.assert_items_equal(dag.nodes, ['a1', 'b1', 'c1', 'd1', 'e2', 'e3',
+                                      'f3'])
+    _assert_parents(dag, 'a1', [])
+    _assert_parents(dag, 'd1', ['b1', 'c1'])
+    _assert_parents(dag, 'f3', ['e2'])
+    _assert_precursors(dag, 'f3', ['e3'])
+    _assert_obsolete(dag, ['e3'])
+
+
+def test_history_revnums():
+    # rev 0 is a real changeset, -1 is the null revision
+    dag = history.parse(['2 1', '1 0', '0 -1'])
+    _assert_parents(dag, '2', ['1'])
+    _assert_parents(dag, '0', [])
+
+
+def test_history_many_revnums():
+    # enough revision numbers (and merges) for names and grid positions to
+    # run together into the same digits
+    parents = {}
+    for rev in xrange(60):
+        parents[str(rev)] = [str(p) for p in (rev - 1, rev - 7)
+                             if p >= 0 and (p == rev - 1 or rev % 5 == 0)]
+    log = ['%d %s' % (rev, ' '.join(parents[str(rev)]) or '-1')
+           for rev in xrange(59, -1, -1)]
+    dag = history.parse(log)
+    nt.assert_equal(len(dag.nodemap), 60)
+    nt.assert_equal(len(set(line.split('(')[1] for line in dag.tikz_lines()
+                            if line.startswith(r'\node'))), 60)
+    for (name, expect) in parents.items():
+        _assert_parents(dag, name, expect)
+
+
+def test_history_window():
+    parents, precursors = history.read(HGLOG.splitlines(), limit=3)
+    nt.assert_items_equal(parents.keys(), ['f3', 'e3', 'e2'])
+    nt.assert_equal(parents['f3'], ['e2'])
+    nt.assert_equal(parents['e2'], [])
+    nt.assert_equal(precursors['f3'], ['e3'])
+
+    parents, precursors = history.read(HGLOG.splitlines(), ancestors='e2')
+    nt.assert_items_equal(parents.keys(), ['e2', 'd1', 'c1', 'b1', 'a1'])
+    nt.assert_equal(precursors, {})
+
+
 def _parse_one(text):
     return dagmatic.parse(text)
 
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+'''Draw a DAG as text, for previews that need neither LaTeX nor a viewer.
+
+The drawing is a cleaned up version of the input: nodes keep their rows and
+columns, but columns are made just wide enough for their labels, and each
+edge is drawn with box-drawing characters (or plain ASCII), as a straight
+line or with one bend. Obsolescence markers are dotted, and transitions are
+drawn under the middle of the dag before them::
+
+  a───b
+
+    ⇓ hg commit --amend
+
+  a─┬─b───c^T
+    │ ┆   ┆
+    └─d┄┄┄┘
+'''
+
+from nodes import TransitionText
+
+# bits of a cell's connections to its neighbours
+N, E, S, W = 1, 2, 4, 8
+
+# glyphs by connections: lines, dotted lines (straight only), transitions
+UNICODE = {
+    'lines': u' │─└││┌├─┘─┴┐┤┬┼',
+    'dotted': {N | S: u'┆', E | W: u'┄'},
+    'arrow': u'⇓ ',
+}
+ASCII = {
+    'lines': ' |-+||++-+-+++++',
+    'dotted': {N | S: ':', E | W: '.'},
+    'arrow': '|| ',
+}
+
+# blank columns between two columns of nodes
+GAP = 3
+
+
+def _label(node):
+    if node.annotation:
+        return u'%s^%s' % (node.text, node.annotation)
+    return node.text
+
+
+def _steps(points):
+    '''yield the cells along a path of horizontal and vertical segments
+    between points, each with the direction to the next cell'''
+    for ((y1, x1), (y2, x2)) in zip(points, points[1:]):
+        while (y1, x1) != (y2, x2):
+            if y1 != y2:
+                step = (1 if y2 > y1 else -1, 0)
+                bits = (S, N) if y2 > y1 else (N, S)
+            else:
+                step = (0, 1 if x2 > x1 else -1)
+                bits = (E, W) if x2 > x1 else (W, E)
+            yield (y1, x1), bits
+            y1, x1 = y1 + step[0], x1 + step[1]
+
+
+def text_lines(dag, ascii=False):
+    '''yield the lines of a drawing of dag (unicode, unless ascii is
+    true)'''
+    glyphs = ASCII if ascii else UNICODE
+    nodes = [n for n in dag.sorted_nodes
+             if not isinstance(n, TransitionText)]
+    transitions = [n for n in dag.sorted_nodes
+                   if isinstance(n, TransitionText)]
+
+    # columns: as wide as their widest label, GAP apart
+    widths = {}
+    for node in nodes:
+        widths[node.col] = max(widths.get(node.col, 0), len(_label(node)))
+    xs = {}
+    x = 0
+    for col in sorted(widths):
+        xs[col] = x
+        x += widths[col] + GAP
+
+    # rows: a line for nodes, one per line of text for transitions, and a
+    # line between each of them for the edges
+    heights = {}
+    for node in nodes:
+        heights[node.row] = 1
+    for node in transitions:
+        heights[node.row] = len(node.text.splitlines())
+    ys = {}
+    y = 0
+    for row in sorted(heights):
+        ys[row] = y
+        y += heights[row] + 1
+
+    lines = {}                          # (y, x) -> connection bits
+    dotted = {}
+
+    def draw(cells, parent, child):
+        y1, x1 = ys[parent.row], xs[parent.col]
+        y2, x2 = ys[child.row], xs[child.col]
+        end = x1 + len(_label(parent)) - 1
+        if parent.col == child.col:
+            path = [(y1, x1), (y2, x2)]
+        elif parent.row == child.row:
+            path = [(y1, end), (y2, x2)]
+        elif x2 < x1:
+            # back to the left (a successor, say): down from the parent
+            path = [(y1, x1), (y2, x1), (y2, x2 + len(_label(child)) - 1)]
+        else:
+            # bend just before the child's column
+            bend = x2 - GAP + 1
+            path = [(y1, end), (y1, bend), (y2, bend), (y2, x2)]
+        for ((cy, cx), (out, back)) in _steps(path):
+            cells[(cy, cx)] = cells.get((cy, cx), 0) | out
+            nexty = cy + (out == S) - (out == N)
+            nextx = cx + (out == E) - (out == W)
+            cells[(nexty, nextx)] = cells.get((nexty, nextx), 0) | back
+
+    for node in nodes:
+        for parent in node.parents:
+            draw(lines, parent, node)
+        for precursor in node.precursors:
+            draw(dotted, precursor, node)
+
+    canvas = {}
+    for (cell, bits) in dotted.items():
+        canvas[cell] = glyphs['dotted'].get(bits, glyphs['lines'][bits])
+    for (cell, bits) in lines.items():
+        canvas[cell] = glyphs['lines'][bits | dotted.get(cell, 0)]
+    for node in nodes:
+        for (i, char) in enumerate(_label(node)):
+            canvas[(ys[node.row], xs[node.col] + i)] = char
+
+    # each transition points down from the middle of the dag above it
+    for node in transitions:
+        above = [n for n in nodes if n.row < node.row and
+                 not any(t.row < node.row and t.row > n.row
+                         for t in transitions)]
+        x = 0
+        if above:
+            left = min(xs[n.col] for n in above)
+            right = max(xs[n.col] + len(_label(n)) for n in above)
+            x = left + (right - left - 1) // 2
+        for (i, text) in enumerate(node.text.splitlines()):
+            if i == 0:
+                text = glyphs['arrow'] + text
+            else:
+                text = ' ' * len(glyphs['arrow']) + text
+            for (j, char) in enumerate(text):
+                canvas[(ys[node.row] + i, x + j)] = char
+
+    height = max([cy for (cy, cx) in canvas] or [-1]) + 1
+    rows = [[] for i in xrange(height)]
+    for ((cy, cx), char) in canvas.items():
+        rows[cy].append((cx, char))
+    for cells in rows:
+        line = []
+        for (cx, char) in sorted(cells):
+            line.extend(u' ' * (cx - len(line)))
+            line.append(char)
+        yield u''.join(line).rstrip()
+
+
+def text_string(dag, ascii=False):
+    lines = list(text_lines(dag, ascii))
+    lines.append(u'')
+    return u'\n'.join(lines)
+
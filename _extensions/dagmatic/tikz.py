@@ -72,6 +72,14 @@ tikzdoc = r'''
     dotted
   },
   markeredge/.default={black},
+%%
+  elidededge/.style={
+    draw=#1,
+    latex-,
+    thick,
+    dashed
+  },
+  elidededge/.default={gray},
 }
 
 \begin{document}
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+import nose.tools as nt
+
+from docutils import core
+from docutils.parsers.rst import directives
+from sphinx import application
+
+import asciidag
+
+
+def _errors(rst):
+    directives.register_directive('dag', asciidag.DagDirective)
+    doctree = core.publish_doctree(rst, settings_overrides={
+        'report_level': 5, 'halt_level': 5})
+    return [m.astext() for m in doctree.traverse(asciidag.nodes.system_message)
+            if m['level'] >= 3]
+
+
+def test_directive_options():
+    # these are rejected before the dag is even parsed
+    errors = _errors('.. dag::\n   :depth: 2\n\n   a-b\n')
+    nt.assert_equal(len(errors), 1)
+    nt.assert_true(':depth: option of dag needs :around:' in errors[0])
+    errors = _errors('.. dag::\n   :around: b\n   :rows: 1-2\n\n   a-b\n')
+    nt.assert_equal(len(errors), 1)
+    nt.assert_true(':around: and :rows: options of dag cannot be combined'
+                   in errors[0])
+
+
+def _build(rst, buildername, srcdir=None, **conf):
+    '''build an index.rst of rst with the extension in a new (or the given)
+    project; return the project directory, the sphinx app and the
+    warnings'''
+    if srcdir is None:
+        srcdir = tempfile.mkdtemp()
+        f = open(os.path.join(srcdir, 'conf.py'), 'w')
+        f.write("extensions = ['asciidag']\nmaster_doc = 'index'\n")
+        for (name, value) in conf.items():
+            f.write('%s = %r\n' % (name, value))
+        f.close()
+        f = open(os.path.join(srcdir, 'index.rst'), 'w')
+        f.write(rst)
+        f.close()
+    warnings = StringIO()
+    app = application.Sphinx(srcdir, srcdir,
+                             os.path.join(srcdir, '_build', buildername),
+                             os.path.join(srcdir, '_build', 'doctrees'),
+                             buildername, status=StringIO(),
+                             warning=warnings)
+    app.build()
+    return srcdir, app, warnings.getvalue()
+
+
+def test_latex_figure_tiles():
+    # the tiles go in the figure sphinx made for the caption, rather than
+    # each in a float of its own inside it
+    srcdir, app, warnings = _build('.. dag:: wide\n   :tiles: 4\n\n'
+                                   '   a-b-c-d-e-f-g-h\n', 'latex')
+    f = open(os.path.join(app.outdir, 'Python.tex'))
+    tex = f.read()
+    f.close()
+    shutil.rmtree(srcdir)
+    nt.assert_equal(tex.count(r'\begin{figure}'), 1)
+    nt.assert_equal(tex.count(r'\caption{wide}'), 1)
+    nt.assert_equal(tex.count(r'\begin{tikzpicture}'), 4)
+
+
+def test_image_size():
+    svgs = [
+        # dvisvgm
+        "<?xml version='1.0' encoding='UTF-8'?>\n"
+        "<svg height='45.5pt' version='1.1' viewBox='0 0 65.4 45.5' "
+        "width='65.4pt' xmlns='http://www.w3.org/2000/svg'>\n</svg>\n",
+        # pdf2svg (cairo)
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<svg xmlns="http://www.w3.org/2000/svg" width="65.4pt" '
+        'height="45.5pt" viewBox="0 0 65.4 45.5" version="1.1">\n</svg>\n',
+    ]
+    for svg in svgs:
+        fd, fn = tempfile.mkstemp(suffix='.svg')
+        os.write(fd, svg)
+        os.close(fd)
+        try:
+            nt.assert_equal(asciidag.image_size(fn), [87, 61])
+        finally:
+            os.remove(fn)
+
+
+class _Builder(object):
+    '''what the shared cache functions use of a builder'''
+    def __init__(self, cachedir, timeout=600):
+        self.confdir = cachedir
+        self.config = type('Config', (), {
+            'dag_cache_dir': cachedir,
+            'dag_cache_lock_timeout': timeout})()
+        self.warnings = []
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+
+def test_cache_lock():
+    cachedir = tempfile.mkdtemp()
+    lockfn = os.path.join(cachedir, 'a.svg.lock')
+    try:
+        slow = _Builder(cachedir)
+        other = _Builder(cachedir)
+        nt.assert_true(asciidag.cache_lock(slow, 'a.svg'))
+        nt.assert_false(asciidag.cache_lock(other, 'a.svg'))
+        # the slow build's lock is broken as stale and taken over...
+        os.utime(lockfn, (0, 0))
+        nt.assert_false(asciidag.cache_lock(other, 'a.svg'))
+        nt.assert_equal(len(other.warnings), 1)
+        nt.assert_true(asciidag.cache_lock(other, 'a.svg'))
+        # ...so when the slow build is done, the lock isn't its to release
+        asciidag.cache_unlock(slow, 'a.svg')
+        nt.assert_true(os.path.exists(lockfn))
+        asciidag.cache_unlock(other, 'a.svg')
+        nt.assert_false(os.path.exists(lockfn))
+    finally:
+        shutil.rmtree(cachedir)
+
+
+def test_cache_heartbeat():
+    # a lock held for longer than the timeout is kept fresh by its build
+    cachedir = tempfile.mkdtemp()
+    lockfn = os.path.join(cachedir, 'a.svg.lock')
+    try:
+        busy = _Builder(cachedir, timeout=0.4)
+        other = _Builder(cachedir, timeout=0.4)
+        nt.assert_true(asciidag.cache_lock(busy, 'a.svg'))
+        for i in xrange(8):
+            time.sleep(0.1)
+            nt.assert_false(asciidag.cache_lock(other, 'a.svg'))
+        nt.assert_equal(other.warnings, [])
+        asciidag.cache_unlock(busy, 'a.svg')
+        nt.assert_false(os.path.exists(lockfn))
+    finally:
+        shutil.rmtree(cachedir)
+
+
+def test_incremental_build():
+    # nothing changed, so the second build has nothing to read
+    srcdir, app, warnings = _build('.. dag::\n\n   a-b-c\n', 'html',
+                                   dag_latex_preamble='bitbucket')
+    try:
+        srcdir, app, warnings = _build(None, 'html', srcdir)
+        status = app._status.getvalue()
+        nt.assert_true('0 added, 0 changed, 0 removed' in status, status)
+    finally:
+        shutil.rmtree(srcdir)